@@ -5,14 +5,15 @@ import argparse
 import sys
 sys.path.append(WORKDIR)
 
-from utils.cfg import QueryProcessorConfig, InvertedListGeneratorConfig, IndexerConfig, SearcherConfig, EvaluatorConfig
+from utils.cfg import QueryProcessorConfig, InvertedListGeneratorConfig, IndexerConfig, SearcherConfig, EvaluatorConfig, BenchmarkConfig
 from utils import log
 from src.queryProcessor import QueryProcessor
 from src.indexer import InvertedListGenerator, Indexer
 from src.searcher import Searcher
 from src.evaluation import ResultsComparison
+from src.benchmark import Benchmark
 
-def search():
+def search(batch = False, numWorkers = 1):
     # Init Loggers
     settingsLogger = log.initLogger("SETTINGS")
 
@@ -68,28 +69,51 @@ def search():
         expectedResultsFilePath = expectedResultsFilePath
     )
 
+    # Without LEIA in INDEX.CFG the inverted list goes straight from the
+    # generator to the indexer, and storing it is only a debug artifact
+    inMemoryInvertedList = "LEIA" not in indexerCFG
+
     # Inverted List   
     documentFilePathList = [os.path.abspath(path) for path in invertedListCFG["LEIA"]]
-    invertedListFilePath = os.path.abspath(invertedListCFG["ESCREVA"])
+    invertedListFilePath = invertedListCFG["ESCREVA"]
     useStemmer = invertedListCFG["STEMMER"]
+    numProcesses = invertedListCFG["PROCESSOS"]
+    # With SEGMENTOS only the document files added since the last execution
+    # are parsed, and their postings are merged into the existing segments
+    segmentsDirPath = invertedListCFG["SEGMENTOS"]
+    if segmentsDirPath is not None:
+        segmentsDirPath = os.path.abspath(segmentsDirPath)
 
-    os.makedirs(os.path.dirname(invertedListFilePath), exist_ok = True)
+    if invertedListFilePath is not None:
+        invertedListFilePath = os.path.abspath(invertedListFilePath)
+        os.makedirs(os.path.dirname(invertedListFilePath), exist_ok = True)
+    elif not inMemoryInvertedList:
+        raise ValueError("GLI.CFG should specify ESCREVA when INDEX.CFG specifies LEIA.")
 
     invertedListGenerator = InvertedListGenerator(
         documentFilePathList = documentFilePathList,
         invertedListFilePath = invertedListFilePath,
-        useStemmer = useStemmer
+        useStemmer = useStemmer,
+        numProcesses = numProcesses,
+        filterTerms = inMemoryInvertedList,
+        segmentsDirPath = segmentsDirPath
     )
 
     ## Indexer  
-    invertedListFilePath = os.path.abspath(indexerCFG["LEIA"])
+    invertedListFilePath = None if inMemoryInvertedList else os.path.abspath(indexerCFG["LEIA"])
     indexesFilePath = os.path.abspath(indexerCFG["ESCREVA"])
+    # With FRAGMENTOS the model is split into that many document shards
+    numShards = int(indexerCFG["FRAGMENTOS"]) if "FRAGMENTOS" in indexerCFG else 1
+    # With COMPRESSAO=VARINT the postings are stored as varint encoded blocks
+    compressPostings = indexerCFG["COMPRESSAO"].strip().upper() == "VARINT" if "COMPRESSAO" in indexerCFG else False
 
     os.makedirs(os.path.dirname(indexesFilePath), exist_ok = True)
 
     indexer = Indexer(
         invertedListFilePath = invertedListFilePath,
-        indexesFilePath = indexesFilePath
+        indexesFilePath = indexesFilePath,
+        numShards = numShards,
+        compressPostings = compressPostings
     )
 
     ## Searcher   
@@ -100,22 +124,39 @@ def search():
     resultsFileName += f"-{'STEMMER' if useStemmer else 'NOSTEMMER'}"
     resultsFilePath = f"{resultsFileDir}/{resultsFileName}{resultsFileExt}"
 
+    # With LIMITE only the top-k documents of each query are retrieved, which
+    # lets the searcher prune documents that cannot reach them. With LIMIAR
+    # only the documents with at least that similarity are retrieved
+    limit = int(searcherCFG["LIMITE"]) if "LIMITE" in searcherCFG else None
+    simThreshold = float(searcherCFG["LIMIAR"]) if "LIMIAR" in searcherCFG else None
+
+    # With CACHE the query results are also kept in a sqlite file, so they are
+    # reused across executions until a different model is indexed
+    cacheFilePath = os.path.abspath(searcherCFG["CACHE"]) if "CACHE" in searcherCFG else None
+    if cacheFilePath is not None:
+        os.makedirs(os.path.dirname(cacheFilePath), exist_ok = True)
+
     os.makedirs(os.path.dirname(resultsFilePath), exist_ok = True)
 
     searcher = Searcher(
         modelFilePath = modelFilePath, 
         queriesFilePath = queriesFilePath,
         resultsFilePath = resultsFilePath,
-        useStemmer = useStemmer
+        useStemmer = useStemmer,
+        batch = batch,
+        numWorkers = numWorkers,
+        limit = limit,
+        simThreshold = simThreshold,
+        cacheFilePath = cacheFilePath
     )
 
     # Putting all together
     queryProcessor.run()
-    invertedListGenerator.run()
-    indexer.run()
+    invertedList = invertedListGenerator.run()
+    indexer.run(invertedList = invertedList if inMemoryInvertedList else None)
     searcher.run()
 
-def eval():
+def eval(plots = True, numWorkers = 1):
     # Init Loggers
     settingsLogger = log.initLogger("SETTINGS")
 
@@ -142,26 +183,56 @@ def eval():
     evaluator = ResultsComparison(
         relevantFilePath = expectedResultsFilePath,
         retrievedList = resultsList,
-        storeDir = storeDir
+        storeDir = storeDir,
+        plots = plots,
+        numWorkers = numWorkers
+    )
+
+    evaluator.evaluateAll(limits = [5, 10], elevenPointsLimit = 10)
+
+def bench():
+    # Init Loggers
+    settingsLogger = log.initLogger("SETTINGS")
+
+    # Loading Settings
+    BENCHMARK_CFG_FILEPATH = os.path.normpath(f"{WORKDIR}/BENCH.CFG")
+
+    benchmarkCFG = log.executeFunction(
+        logger = settingsLogger,
+        onStartMessage = "Loading benchmark settings",
+        onFinishMessage = "Benchmark settings were loaded with success",
+        logResults = True,
+        func = BenchmarkConfig(configPath = BENCHMARK_CFG_FILEPATH).loadConfig
+    )
+
+    # Benchmark
+    resultsFilePath = os.path.abspath(benchmarkCFG["ESCREVA"])
+    os.makedirs(os.path.dirname(resultsFilePath), exist_ok = True)
+
+    benchmark = Benchmark(
+        documentFilePathList = [os.path.abspath(path) for path in benchmarkCFG["LEIA"]],
+        queriesFilePath = os.path.abspath(benchmarkCFG["CONSULTAS"]),
+        workDirPath = os.path.abspath(benchmarkCFG["DIRETORIO"]),
+        resultsFilePath = resultsFilePath,
+        scales = benchmarkCFG["ESCALAS"],
+        useStemmer = benchmarkCFG["STEMMER"],
+        numProcesses = benchmarkCFG["PROCESSOS"],
+        numShards = int(benchmarkCFG["FRAGMENTOS"]) if "FRAGMENTOS" in benchmarkCFG else 1,
+        compressPostings = benchmarkCFG["COMPRESSAO"].strip().upper() == "VARINT" if "COMPRESSAO" in benchmarkCFG else False,
+        limit = benchmarkCFG["LIMITE"]
     )
 
-    evaluator.elevenPoints(limit = 10)
-    evaluator.f1(limit = 10)
-    evaluator.precision(limit = 5)
-    evaluator.precision(limit = 10)
-    # TODO: Generate R-Precision for other pairs of result datasets
-    evaluator.rPrecisionHistogram(resultsList[0]["name"], resultsList[1]["name"])
-    evaluator.meanAveragePrecision()
-    evaluator.meanReciprocalRank(limit = 10)
-    evaluator.discountedCumulativeGain(limit = 10)
-    evaluator.normalizedDiscountedCumulativeGain(limit = 10)
+    benchmark.run()
 
 if __name__ == "__main__":
     # Logger
     logger = log.initLogger("MAIN")
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("-m", "--mode", help = "Execution mode ('search' or 'eval')", dest = "mode", default = "search")
+    parser.add_argument("-m", "--mode", help = "Execution mode ('search', 'eval' or 'bench')", dest = "mode", default = "search")
+    parser.add_argument("-b", "--batch", help = "Score all queries at once with a sparse matrix product (search mode)", dest = "batch", action = "store_true")
+    parser.add_argument("-w", "--workers", help = "Number of processes running the queries (search mode) or rendering the figures (eval mode)", dest = "workers", type = int, default = 1)
+    parser.add_argument("--no-plots", help = "Compute and store the metrics without rendering any figure (eval mode)", dest = "plots", action = "store_false")
     args = parser.parse_args()
 
     executionMode = args.mode
@@ -173,7 +244,9 @@ if __name__ == "__main__":
             onStartMessage = "Welcome! The system has been started in search mode",
             onFinishMessage = "All done! The system has been finished", 
             onErrorMessage = "An error was found while executing the system",
-            func = search
+            func = search,
+            batch = args.batch,
+            numWorkers = args.workers
         )
 
     # Evaluation
@@ -183,8 +256,20 @@ if __name__ == "__main__":
             onStartMessage = "Welcome! The system has been started in evaluation mode",
             onFinishMessage = "All done! The system has been finished", 
             onErrorMessage = "An error was found while executing the system",
-            func = eval
+            func = eval,
+            plots = args.plots,
+            numWorkers = args.workers
         )
     
+    # Benchmark
+    elif executionMode == "bench":
+        log.executeFunction(
+            logger, 
+            onStartMessage = "Welcome! The system has been started in benchmark mode",
+            onFinishMessage = "All done! The system has been finished", 
+            onErrorMessage = "An error was found while executing the system",
+            func = bench
+        )
+
     else:
-        raise ValueError("Mode should be either 'search' or 'eval'.")
\ No newline at end of file
+        raise ValueError("Mode should be either 'search', 'eval' or 'bench'.")
\ No newline at end of file
@@ -0,0 +1,360 @@
+import os
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = f"{SCRIPT_DIR}/.."
+
+import sys
+sys.path.append(PROJECT_DIR)
+
+import json
+import platform
+import resource
+import subprocess
+import numpy as np
+import multiprocessing
+from time import perf_counter
+from datetime import datetime, timezone
+from typing import Text, List
+from xml.sax.saxutils import escape
+from concurrent.futures import ProcessPoolExecutor
+from utils import log
+from src.queryProcessor import QueryProcessor
+from src.indexer import InvertedListGenerator, Indexer
+from src.searcher import Searcher
+from src.evaluation import ResultsComparison
+from src.model import loadModel, ShardedTermDocumentMatrix
+
+BENCHMARK_VERSION = 1
+
+# Synthetic records are written in files of at most this many records
+SYNTHETIC_FILE_RECORDS = 10000
+
+class Benchmark:
+    # Runs the whole pipeline (InvertedListGenerator, Indexer, Searcher and
+    # ResultsComparison) on the CF collection and on synthetic collections
+    # scale times as large, and stores the throughput, latency, memory and
+    # model size of each stage as JSON. A synthetic collection holds the CF
+    # documents plus (scale - 1) times as many generated ones, whose lengths
+    # and words are drawn from the CF documents, so the CF queries and
+    # expected results still apply. The Searcher stores and the evaluation
+    # reads only the top limit documents of each query, so their memory and
+    # the results file do not grow with the collection. Each stage runs in a
+    # fresh process, so its peak RSS is not inflated by the stages before it
+    def __init__(
+        self,
+        documentFilePathList: List[Text],
+        queriesFilePath: Text,
+        workDirPath: Text,
+        resultsFilePath: Text,
+        scales: List[int] = [1, 10, 100, 1000],
+        useStemmer: bool = False,
+        numProcesses: int = 1,
+        numShards: int = 1,
+        compressPostings: bool = False,
+        limit: int = 10,
+        queryRepeats: int = 3,
+        seed: int = 0
+    ):
+        self.documentFilePathList = documentFilePathList
+        self.queriesFilePath = queriesFilePath
+        self.workDirPath = workDirPath
+        self.resultsFilePath = resultsFilePath
+        self.scales = scales
+        self.useStemmer = useStemmer
+        self.numProcesses = numProcesses
+        self.numShards = numShards
+        self.compressPostings = compressPostings
+        self.limit = limit
+        self.queryRepeats = queryRepeats
+        self.seed = seed
+        self.documentsData = None
+        self.results = None
+        self.logger = log.initLogger("BENCHMARK")
+
+    def getProcessedQueriesFilePath(self) -> Text:
+        return os.path.join(self.workDirPath, "CONSULTAS.csv")
+
+    def getExpectedResultsFilePath(self) -> Text:
+        return os.path.join(self.workDirPath, "ESPERADOS.csv")
+
+    def processQueries(self):
+        QueryProcessor(
+            queriesFilePath = self.queriesFilePath,
+            processedQueriesFilePath = self.getProcessedQueriesFilePath(),
+            expectedResultsFilePath = self.getExpectedResultsFilePath()
+        ).run()
+
+    def loadDocuments(self):
+        # Record numbers and raw texts of the CF documents, the source of the
+        # synthetic documents
+        invertedListGenerator = InvertedListGenerator(self.documentFilePathList, None)
+        records = [
+            (recordNum, text)
+            for documentFilePath in self.documentFilePathList
+            for recordNum, text in invertedListGenerator.iterDocument(documentFilePath)
+        ]
+        return records
+
+    def generateCorpus(self, scale: int, scaleDirPath: Text) -> List[Text]:
+        # Document files of a collection scale times as large as the CF one
+        if scale <= 1:
+            return list(self.documentFilePathList)
+
+        words = [text.split() for _, text in self.documentsData if text is not None]
+        documentLengths = np.array([len(documentWords) for documentWords in words])
+        vocabulary, wordCounts = np.unique([word for documentWords in words for word in documentWords], return_counts = True)
+        vocabulary = np.array([escape(word) for word in vocabulary], dtype = object)
+        wordProbabilities = wordCounts/wordCounts.sum()
+        firstRecordNum = max(int(recordNum) for recordNum, _ in self.documentsData) + 1
+
+        rng = np.random.default_rng(self.seed + scale)
+        numRecords = (scale - 1)*len(self.documentsData)
+        documentFilePathList = list(self.documentFilePathList)
+        for fileNumber, start in enumerate(range(0, numRecords, SYNTHETIC_FILE_RECORDS)):
+            size = min(SYNTHETIC_FILE_RECORDS, numRecords - start)
+            lengths = rng.choice(documentLengths, size = size)
+            documentWords = np.split(rng.choice(vocabulary, size = lengths.sum(), p = wordProbabilities), np.cumsum(lengths)[:-1])
+
+            documentFilePath = os.path.join(scaleDirPath, f"synthetic{fileNumber:05d}.xml")
+            with open(documentFilePath, "w", encoding = "utf-8") as f:
+                f.write('<?xml version="1.0" encoding="UTF-8"?>\n<root>\n')
+                for offset, recordWords in enumerate(documentWords):
+                    recordNum = firstRecordNum + start + offset
+                    f.write(f"<RECORD>\n<RECORDNUM>{recordNum:05d}</RECORDNUM>\n<ABSTRACT>{' '.join(recordWords)}</ABSTRACT>\n</RECORD>\n")
+                f.write("</root>\n")
+            documentFilePathList.append(documentFilePath)
+        return documentFilePathList
+
+    def runStage(self, stageFunc, **kwargs):
+        # Each stage runs in a new (spawned, not forked) process, so that its
+        # peak RSS only covers the stage itself
+        with ProcessPoolExecutor(max_workers = 1, mp_context = multiprocessing.get_context("spawn")) as executor:
+            return executor.submit(stageFunc, **kwargs).result()
+
+    def runScale(self, scale: int):
+        scaleDirPath = os.path.join(self.workDirPath, f"scale{scale}")
+        os.makedirs(scaleDirPath, exist_ok = True)
+        invertedListFilePath = os.path.join(scaleDirPath, "LISTA_INVERTIDA.npz")
+        modelFilePath = os.path.join(scaleDirPath, "MODELO.bin")
+        resultsFilePath = os.path.join(scaleDirPath, "RESULTADOS.csv")
+
+        documentFilePathList = log.executeFunction(
+            logger = self.logger,
+            onStartMessage = f"Generating collection (scale = {scale})",
+            onFinishMessage = "Collection was generated with success",
+            onErrorMessage = "Error while generating collection",
+            func = self.generateCorpus,
+            scale = scale,
+            scaleDirPath = scaleDirPath
+        )
+        numDocuments = scale*len(self.documentsData)
+
+        invertedListStats = self.runStage(
+            benchmarkInvertedListGenerator,
+            documentFilePathList = documentFilePathList,
+            invertedListFilePath = invertedListFilePath,
+            useStemmer = self.useStemmer,
+            numProcesses = self.numProcesses
+        )
+        indexerStats = self.runStage(
+            benchmarkIndexer,
+            invertedListFilePath = invertedListFilePath,
+            modelFilePath = modelFilePath,
+            numShards = self.numShards,
+            compressPostings = self.compressPostings
+        )
+        searcherStats = self.runStage(
+            benchmarkSearcher,
+            modelFilePath = modelFilePath,
+            queriesFilePath = self.getProcessedQueriesFilePath(),
+            resultsFilePath = resultsFilePath,
+            useStemmer = self.useStemmer,
+            limit = self.limit,
+            queryRepeats = self.queryRepeats
+        )
+        evaluationStats = self.runStage(
+            benchmarkResultsComparison,
+            expectedResultsFilePath = self.getExpectedResultsFilePath(),
+            resultsFilePath = resultsFilePath,
+            storeDirPath = os.path.join(scaleDirPath, "AVALIACAO")
+        )
+
+        invertedListStats["documentsPerSecond"] = numDocuments/invertedListStats["seconds"]
+        indexerStats["documentsPerSecond"] = numDocuments/indexerStats["seconds"]
+        return {
+            "scale": scale,
+            "documents": numDocuments,
+            "invertedListGenerator": invertedListStats,
+            "indexer": indexerStats,
+            "searcher": searcherStats,
+            "evaluation": evaluationStats
+        }
+
+    def getEnvironment(self):
+        try:
+            commit = subprocess.run(
+                ["git", "rev-parse", "HEAD"], cwd = PROJECT_DIR, capture_output = True, text = True, check = True
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            commit = None
+        return {
+            "commit": commit,
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count()
+        }
+
+    def storeResults(self):
+        with open(self.resultsFilePath, "w") as f:
+            json.dump(self.results, f, indent = 4)
+
+    def _run(self):
+        os.makedirs(self.workDirPath, exist_ok = True)
+        self.results = {
+            "version": BENCHMARK_VERSION,
+            "environment": self.getEnvironment(),
+            "settings": {
+                "useStemmer": self.useStemmer,
+                "numProcesses": self.numProcesses,
+                "numShards": self.numShards,
+                "compressPostings": self.compressPostings,
+                "limit": self.limit,
+                "queryRepeats": self.queryRepeats,
+                "seed": self.seed
+            },
+            "scales": []
+        }
+
+        log.executeFunction(
+            logger = self.logger,
+            onStartMessage = "Processing queries",
+            onFinishMessage = "Queries were processed with success",
+            onErrorMessage = "Error while processing queries",
+            func = self.processQueries
+        )
+
+        self.documentsData = log.executeFunction(
+            logger = self.logger,
+            onStartMessage = "Loading documents",
+            onFinishMessage = "Documents were loaded with success",
+            onErrorMessage = "Error while loading documents",
+            func = self.loadDocuments
+        )
+        self.logger.info(f"Total Documents: {len(self.documentsData)}")
+
+        for scale in self.scales:
+            scaleResults = log.executeFunction(
+                logger = self.logger,
+                onStartMessage = f"Running benchmark (scale = {scale})",
+                onFinishMessage = f"Benchmark was executed with success (scale = {scale})",
+                onErrorMessage = f"Error while running benchmark (scale = {scale})",
+                func = self.runScale,
+                scale = scale
+            )
+            # Results are stored after every scale, so a long run that fails
+            # at a larger scale still keeps the smaller ones
+            self.results["scales"].append(scaleResults)
+            self.storeResults()
+        self.logger.info(f"Benchmark results were stored in {self.resultsFilePath}")
+
+    def run(self):
+        log.executeModule(self.logger, self._run)
+
+def getPeakRSS() -> int:
+    # Peak resident set size (in bytes) of this process and of the processes
+    # it waited for, such as the workers of a process pool
+    peakRSS = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    )
+    # ru_maxrss is in kilobytes, except on macOS
+    return peakRSS if sys.platform == "darwin" else 1024*peakRSS
+
+def benchmarkInvertedListGenerator(documentFilePathList: List[Text], invertedListFilePath: Text, useStemmer: bool, numProcesses: int):
+    startTime = perf_counter()
+    InvertedListGenerator(
+        documentFilePathList = documentFilePathList,
+        invertedListFilePath = invertedListFilePath,
+        useStemmer = useStemmer,
+        numProcesses = numProcesses
+    ).run()
+    return {"seconds": perf_counter() - startTime, "peakRSS": getPeakRSS()}
+
+def benchmarkIndexer(invertedListFilePath: Text, modelFilePath: Text, numShards: int, compressPostings: bool):
+    startTime = perf_counter()
+    Indexer(
+        invertedListFilePath = invertedListFilePath,
+        indexesFilePath = modelFilePath,
+        numShards = numShards,
+        compressPostings = compressPostings
+    ).run()
+    seconds = perf_counter() - startTime
+
+    model = loadModel(modelFilePath)
+    modelFilePaths = [modelFilePath] + (model.shardFilePaths if isinstance(model, ShardedTermDocumentMatrix) else [])
+    return {
+        "seconds": seconds,
+        "peakRSS": getPeakRSS(),
+        "modelBytes": sum(os.path.getsize(filePath) for filePath in modelFilePaths)
+    }
+
+def benchmarkSearcher(modelFilePath: Text, queriesFilePath: Text, resultsFilePath: Text, useStemmer: bool, limit: int, queryRepeats: int):
+    # Latency of each query (text processing and top limit scoring, without
+    # the query result cache), followed by the throughput of runQueries, whose
+    # results are stored for the evaluation, and of runQueriesBatch
+    searcher = Searcher(
+        modelFilePath = modelFilePath,
+        queriesFilePath = queriesFilePath,
+        resultsFilePath = resultsFilePath,
+        useStemmer = useStemmer
+    )
+    startTime = perf_counter()
+    searcher.model = searcher.loadModel()
+    loadSeconds = perf_counter() - startTime
+    searcher.queries = searcher.loadQueries()
+
+    latencies = []
+    for _ in range(queryRepeats):
+        for query in searcher.queries.queryText:
+            startTime = perf_counter()
+            searcher.searchFromQuery(query, limit = limit)
+            latencies.append(perf_counter() - startTime)
+    latencies = 1000*np.array(latencies)
+
+    startTime = perf_counter()
+    results = searcher.runQueries(limit = limit)
+    seconds = perf_counter() - startTime
+    results.to_csv(resultsFilePath, index = False, sep = ";")
+
+    startTime = perf_counter()
+    searcher.runQueriesBatch(limit = limit)
+    batchSeconds = perf_counter() - startTime
+
+    numQueries = searcher.queries.shape[0]
+    return {
+        "queries": numQueries,
+        "loadSeconds": loadSeconds,
+        "latencyMilliseconds": {
+            "mean": float(latencies.mean()),
+            "p50": float(np.percentile(latencies, 50)),
+            "p95": float(np.percentile(latencies, 95)),
+            "p99": float(np.percentile(latencies, 99))
+        },
+        "seconds": seconds,
+        "queriesPerSecond": numQueries/seconds,
+        "batchSeconds": batchSeconds,
+        "batchQueriesPerSecond": numQueries/batchSeconds,
+        "peakRSS": getPeakRSS()
+    }
+
+def benchmarkResultsComparison(expectedResultsFilePath: Text, resultsFilePath: Text, storeDirPath: Text):
+    os.makedirs(storeDirPath, exist_ok = True)
+    startTime = perf_counter()
+    ResultsComparison(
+        relevantFilePath = expectedResultsFilePath,
+        retrievedList = [{"name": "BENCHMARK", "filepath": resultsFilePath}],
+        storeDir = storeDirPath,
+        plots = False
+    ).evaluateAll(significanceMetrics = [])
+    return {"seconds": perf_counter() - startTime, "peakRSS": getPeakRSS()}
@@ -6,18 +6,23 @@ PROJECT_DIR = f"{SCRIPT_DIR}/.."
 import sys
 sys.path.append(PROJECT_DIR)
 
+import numpy as np
 import pandas as pd
 from utils import log
 from utils import metrics
+from utils import significance
 from typing import Text, List, Dict
-from matplotlib import pyplot as plt
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
 
 class ResultsComparison:
     def __init__(
         self, 
         relevantFilePath: Text, 
         retrievedList: List[Dict], # Each dict element should have the following keys: name and filepath
-        storeDir: Text = None
+        storeDir: Text = None,
+        plots: bool = True,
+        numWorkers: int = 1
     ):
         self.relevant = pd.read_csv(relevantFilePath, sep = ";").rename(
             columns = {
@@ -39,29 +44,139 @@ class ResultsComparison:
             } for retrieved in retrievedList
         ]
         self.storeDir = storeDir
+        self.plots = plots
+        self.numWorkers = numWorkers
+        self.executor = None
+        self.plotFutures = []
+        self.judgedRankings = {}
+        self.scores = {}
         self.logger = log.initLogger("EVALUATOR")
 
+    def getJudgedRankings(self, name: Text, limit = None):
+        # Each run is joined with the judgments once, with no limit, and any
+        # limit is a slice of that ranking
+        if name not in self.judgedRankings:
+            names = [retrieved["name"] for retrieved in self.retrievedList]
+            data = self.retrievedList[names.index(name)]["data"]
+            self.judgedRankings[name] = metrics.getJudgedRankings(data, self.relevant)
+        return metrics.truncateJudgedRankings(self.judgedRankings[name], limit)
+
+    def getScores(self, name: Text, limit = None) -> pd.DataFrame:
+        # Every per query metric of a run at a limit, computed once
+        if (name, limit) not in self.scores:
+            self.scores[(name, limit)] = metrics.scoreJudgedRankings(self.getJudgedRankings(name, limit))
+        return self.scores[(name, limit)]
+
+    def saveFigure(self, plotFunc, data, filePath: Text, **kwargs):
+        # Figures are skipped without plots, and rendered by the pool of
+        # evaluateAll when it has one
+        if not self.plots:
+            return
+        if self.executor is None:
+            renderFigure(plotFunc, data, filePath, **kwargs)
+        else:
+            self.plotFutures.append(self.executor.submit(renderFigure, plotFunc, data, filePath, **kwargs))
+
+    def getRunPairs(self):
+        names = [retrieved["name"] for retrieved in self.retrievedList]
+        return [(firstName, secondName) for i, firstName in enumerate(names) for secondName in names[i + 1:]]
+
+    def evaluateAll(
+        self,
+        limits: List[int] = [5, 10],
+        elevenPointsLimit: int = 10,
+        significanceMetrics: List[Text] = ["_meanAveragePrecisionScore", "_rPrecisionScore", "_normalizedDiscountedCumulativeGainScore"],
+        numResamples: int = 10000
+    ):
+        # Every metric of every run from the judged rankings cached per run:
+        # precision, recall, F1, MRR, DCG and NDCG at each limit, MAP, the
+        # eleven points curve, the R-Precision histogram of each pair of runs
+        # and the significance tests of each pair of runs for every metric in
+        # significanceMetrics, over the whole rankings and at each limit. With
+        # more than one worker, a pool of processes renders the figures while
+        # the metrics are computed, and runs the significance tests
+        self.logger.info(f"Generating all metrics (limits = {limits})")
+        if self.numWorkers > 1:
+            self.executor = ProcessPoolExecutor(max_workers = self.numWorkers)
+        try:
+            self.elevenPoints(limit = elevenPointsLimit)
+            for limit in limits:
+                self.precision(limit = limit)
+                self.recall(limit = limit)
+                self.f1(limit = limit)
+            for firstRetrievedName, secondRetrievedName in self.getRunPairs():
+                self.rPrecisionHistogram(firstRetrievedName, secondRetrievedName)
+            self.meanAveragePrecision()
+            for limit in limits:
+                self.meanReciprocalRank(limit = limit)
+                self.discountedCumulativeGain(limit = limit)
+                self.normalizedDiscountedCumulativeGain(limit = limit)
+            for metric in significanceMetrics:
+                for limit in [None] + list(limits):
+                    self.significanceTests(metric, limit = limit, numResamples = numResamples)
+            for future in self.plotFutures:
+                future.result()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+            self.executor = None
+            self.plotFutures = []
+        self.logger.info("All metrics generated with success")
+
+    def significanceTests(self, metric: Text, limit = None, method: Text = "randomization", numResamples: int = 10000, seed: int = 0):
+        # Paired test of the per query scores of metric (one of
+        # metrics.SCALAR_METRICS) between every pair of runs, on the queries
+        # scored in both runs. Undefined scores (e.g. the precision of a query
+        # that retrieved nothing) count as 0
+        self.logger.info(f"Generating {method} tests of {metric} (limit = {limit}, resamples = {numResamples})")
+        if metric not in metrics.SCALAR_METRICS:
+            raise ValueError(f"Significance tests can only be calculated for the following metrics: {', '.join(metrics.SCALAR_METRICS)}")
+
+        pairs = self.getRunPairs()
+        pairScores = []
+        for firstRetrievedName, secondRetrievedName in pairs:
+            scores = pd.concat([
+                self.getScores(firstRetrievedName, limit).set_index("queryNumber")[metric],
+                self.getScores(secondRetrievedName, limit).set_index("queryNumber")[metric]
+            ], axis = 1, join = "inner").fillna(0).to_numpy()
+            pairScores.append((scores[:, 0], scores[:, 1]))
+
+        testArgs = (repeat(method), repeat(numResamples), repeat(seed))
+        firstScores, secondScores = [scores[0] for scores in pairScores], [scores[1] for scores in pairScores]
+        if self.executor is not None:
+            results = list(self.executor.map(significance.pairedTest, firstScores, secondScores, *testArgs))
+        elif self.numWorkers > 1:
+            with ProcessPoolExecutor(max_workers = self.numWorkers) as executor:
+                results = list(executor.map(significance.pairedTest, firstScores, secondScores, *testArgs))
+        else:
+            results = list(map(significance.pairedTest, firstScores, secondScores, *testArgs))
+
+        df = pd.DataFrame([
+            {"firstRun": firstRetrievedName, "secondRun": secondRetrievedName, "numQueries": len(scores[0]), **result}
+            for (firstRetrievedName, secondRetrievedName), scores, result in zip(pairs, pairScores, results)
+        ], columns = ["firstRun", "secondRun", "numQueries", "meanA", "meanB", "delta", "pValue"])
+
+        metricName = metric.strip("_")
+        filename = f"significance-{metricName}-1.csv" if limit is None else f"significanceAt{limit}-{metricName}-1.csv"
+        df.to_csv(f"{self.storeDir}/{filename}", index = False, sep = ";")
+        self.logger.info("Significance tests generated with success")
+
     def elevenPoints(self, limit = None):
         self.logger.info(f"Generating eleven points plot (limit = {limit})")
         for retrieved in self.retrievedList:
             name = retrieved["name"]
-            data = retrieved["data"]
-            relevant = self.relevant
-
-            df, fig = metrics.plotElevenPoints(data, relevant, limit = limit)
 
+            df = metrics.getElevenPoints(self.getJudgedRankings(name, limit))
             df.to_csv(f"{self.storeDir}/11points-{name}-1.csv", index = False, sep = ";")
-            fig.savefig(f"{self.storeDir}/11points-{name}-2.png")
+            self.saveFigure(metrics.plotElevenPointsCurve, df, f"{self.storeDir}/11points-{name}-2.png")
         self.logger.info("Eleven points plot generated and stored with success")
 
     def f1(self, limit = None):
         self.logger.info(f"Generating F1 score (limit = {limit})")
         for retrieved in self.retrievedList:
             name = retrieved["name"]
-            data = retrieved["data"]
-            relevant = self.relevant
 
-            df = metrics.getMetricScore(data, relevant, scoreFuncs = [metrics._f1Score], limit = limit)
+            df = self.getScores(name, limit)[["queryNumber", "_f1Score"]]
 
             filename = f"f1-{name}-1.csv" if limit is None else f"f1At{limit}-{name}-1.csv"
             df.to_csv(f"{self.storeDir}/{filename}", index = False, sep = ";")
@@ -71,10 +186,8 @@ class ResultsComparison:
         self.logger.info(f"Generating precision score (limit = {limit})")
         for retrieved in self.retrievedList:
             name = retrieved["name"]
-            data = retrieved["data"]
-            relevant = self.relevant
 
-            df = metrics.getMetricScore(data, relevant, scoreFuncs = [metrics._precisionScore], limit = limit)
+            df = self.getScores(name, limit)[["queryNumber", "_precisionScore"]]
 
             filename = f"precision-{name}-1.csv" if limit is None else f"precisionAt{limit}-{name}-1.csv"
             df.to_csv(f"{self.storeDir}/{filename}", index = False, sep = ";")
@@ -84,10 +197,8 @@ class ResultsComparison:
         self.logger.info(f"Generating recall score (limit = {limit})")
         for retrieved in self.retrievedList:
             name = retrieved["name"]
-            data = retrieved["data"]
-            relevant = self.relevant
 
-            df = metrics.getMetricScore(data, relevant, scoreFuncs = [metrics._recallScore], limit = limit)
+            df = self.getScores(name, limit)[["queryNumber", "_recallScore"]]
 
             filename = f"recall-{name}-1.csv" if limit is None else f"recallAt{limit}-{name}-1.csv"
             df.to_csv(f"{self.storeDir}/{filename}", index = False, sep = ";")
@@ -98,27 +209,26 @@ class ResultsComparison:
         names = [retrieved["name"] for retrieved in self.retrievedList]
         if firstRetrievedName not in names or secondRetrievedName not in names:
             raise ValueError(f"R-Precision can only be calculated for the following data: {', '.join(names)}")
-        
-        firstRetrievedData = self.retrievedList[names.index(firstRetrievedName)]["data"]
-        secondRetrievedData = self.retrievedList[names.index(secondRetrievedName)]["data"]
-
-        df, fig = metrics.rPrecisionHistogram(firstRetrievedData, secondRetrievedData, self.relevant)
-        plt.ylabel(f"R-Precision {firstRetrievedName}/{secondRetrievedName}")
 
+        df = metrics.getRPrecisionDelta(
+            self.getScores(firstRetrievedName)[["queryNumber", "_rPrecisionScore"]],
+            self.getScores(secondRetrievedName)[["queryNumber", "_rPrecisionScore"]]
+        )
         filename = f"rPrecision-{firstRetrievedName}-{secondRetrievedName}"
 
         df.to_csv(f"{self.storeDir}/{filename}-1.csv", index = False, sep = ";")
-        fig.savefig(f"{self.storeDir}/{filename}-2.png")
+        self.saveFigure(
+            metrics.plotRPrecisionHistogram, df, f"{self.storeDir}/{filename}-2.png",
+            ylabel = f"R-Precision {firstRetrievedName}/{secondRetrievedName}"
+        )
         self.logger.info("R-Precision generated with success")
 
     def meanAveragePrecision(self):
         self.logger.info(f"Generating MAP score")
         for retrieved in self.retrievedList:
             name = retrieved["name"]
-            data = retrieved["data"]
-            relevant = self.relevant
 
-            mapScore = metrics.meanAveragePrecision(data, relevant)
+            mapScore = self.getScores(name)._meanAveragePrecisionScore.mean()
 
             filename = f"map-{name}-1.csv"
             with open(f"{self.storeDir}/{filename}", "w") as f:
@@ -129,10 +239,8 @@ class ResultsComparison:
         self.logger.info(f"Generating MRR score")
         for retrieved in self.retrievedList:
             name = retrieved["name"]
-            data = retrieved["data"]
-            relevant = self.relevant
 
-            mrrScore = metrics.meanReciprocalRank(data, relevant, limit = limit)
+            mrrScore = self.getScores(name, limit)._meanReciprocalRankScore.mean()
 
             filename = f"mrr-{name}-1.csv" if limit is None else f"mrrAt{limit}-{name}-1.csv"
             with open(f"{self.storeDir}/{filename}", "w") as f:
@@ -143,27 +251,39 @@ class ResultsComparison:
         self.logger.info(f"Generating DCG score (limit = {limit})")
         for retrieved in self.retrievedList:
             name = retrieved["name"]
-            data = retrieved["data"]
-            relevant = self.relevant
 
-            df, fig = metrics.discountedCumulativeGain(data, relevant, limit = limit)
-            df = pd.Series(df)
+            score = metrics.getAverageDiscountedCumulativeGains(self.getJudgedRankings(name, limit))
+            df = pd.Series(score)
 
             filename = f"dcg-{name}" if limit is None else f"dcgAt{limit}-{name}"
             df.to_csv(f"{self.storeDir}/{filename}-1.csv", index = False, sep = ";")
-            fig.savefig(f"{self.storeDir}/{filename}-2.png")
+            self.saveFigure(metrics.plotDiscountedCumulativeGain, score, f"{self.storeDir}/{filename}-2.png")
         self.logger.info("DCG generated with success")
 
     def normalizedDiscountedCumulativeGain(self, limit = None):
+        # NDCG@k of every query at every rank k up to the limit, in one call,
+        # stored along with its average over the queries
         self.logger.info(f"Generating NDCG score (limit = {limit})")
         for retrieved in self.retrievedList:
             name = retrieved["name"]
-            data = retrieved["data"]
-            relevant = self.relevant
 
-            df = metrics.normalizedDiscountedCumulativeGain(data, relevant, limit = limit)
-            df = pd.Series(df)
+            judgedRankings = self.getJudgedRankings(name, limit)
+            numRanks = judgedRankings["relevance"].shape[1] if limit is None else limit
+            ks = np.arange(1, numRanks + 1)
+            scores = metrics.getNormalizedDiscountedCumulativeGains(judgedRankings, ks)
+            df = pd.Series(scores.mean(axis = 0))
+            queriesDF = pd.DataFrame(scores, columns = [f"ndcgAt{k}" for k in ks])
+            queriesDF.insert(0, "queryNumber", judgedRankings["queryNumber"])
 
             filename = f"ndcg-{name}" if limit is None else f"ndcgAt{limit}-{name}"
             df.to_csv(f"{self.storeDir}/{filename}-1.csv", index = False, sep = ";")
-        self.logger.info("NDCG generated with success")
\ No newline at end of file
+            queriesDF.to_csv(f"{self.storeDir}/{filename}-queries-1.csv", index = False, sep = ";")
+        self.logger.info("NDCG generated with success")
+
+def renderFigure(plotFunc, data, filePath: Text, **kwargs):
+    # Draws and stores a figure, closing it so that figures do not pile up in
+    # a long evaluation (or in a worker process)
+    plt, _ = metrics.importPlotting()
+    fig = plotFunc(data, **kwargs)
+    fig.savefig(filePath)
+    plt.close(fig)
@@ -1,7 +1,7 @@
 import os
-import ast
+import json
+import numpy as np
 import pandas as pd
-import pickle
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 PROJECT_DIR = f"{SCRIPT_DIR}/.."
@@ -10,85 +10,344 @@ import sys
 sys.path.append(PROJECT_DIR)
 
 from typing import Text, List
-from xml.dom import minidom
-from utils.textProcessing import vectorizeText
+from collections import Counter
+from functools import partial
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from xml.etree import ElementTree
+from utils.textProcessing import getTextPipeline
 from utils import log
-from src.model import TermDocumentMatrix
+from src.model import TermDocumentMatrix, ShardedTermDocumentMatrix
 from utils.weight import StandardTFIDF
 
+# Compact inverted list layout (ESCREVA/LEIA paths ending in .npz): a
+# compressed .npz archive with the sorted terms, the term offsets, the document
+# IDs and, for every (term, document) posting, the gap to the previous document
+# ordinal of the same term and the term count
+INVERTED_LIST_VERSION = 1
+
+# Records are preprocessed in chunks of at most this many documents
+DOCUMENT_CHUNK_SIZE = 256
+
+INVERTED_LIST_EXTENSIONS = [".csv", ".npz"]
+
+def isCompactInvertedListFile(invertedListFilePath: Text) -> bool:
+    extension = os.path.splitext(invertedListFilePath)[1].lower()
+    if extension not in INVERTED_LIST_EXTENSIONS:
+        raise ValueError(f"Inverted list file should have one of the following extensions: {', '.join(INVERTED_LIST_EXTENSIONS)}")
+    return extension == ".npz"
+
+def storeCompactInvertedList(invertedListFilePath: Text, invertedList: pd.DataFrame):
+    terms, termOrdinals = np.unique(invertedList.term.to_numpy().astype(str), return_inverse = True)
+    documentIDs, documentOrdinals = np.unique(invertedList.documentID.to_numpy().astype(str), return_inverse = True)
+    order = np.lexsort((documentOrdinals, termOrdinals))
+    termOrdinals, documentOrdinals = termOrdinals[order], documentOrdinals[order]
+
+    termOffsets = np.zeros(len(terms) + 1, dtype = np.int64)
+    termOffsets[1:] = np.cumsum(np.bincount(termOrdinals, minlength = len(terms)))
+    documentGaps = np.diff(documentOrdinals, prepend = 0)
+    documentGaps[termOffsets[:-1]] = documentOrdinals[termOffsets[:-1]]
+
+    with open(invertedListFilePath, "wb") as f:
+        np.savez_compressed(
+            f,
+            version = np.array(INVERTED_LIST_VERSION),
+            terms = terms,
+            termOffsets = termOffsets,
+            documentIDs = documentIDs,
+            documentGaps = documentGaps.astype(np.uint32),
+            termCounts = invertedList.termCount.to_numpy()[order].astype(np.uint32)
+        )
+
+def loadCompactInvertedList(invertedListFilePath: Text) -> pd.DataFrame:
+    with np.load(invertedListFilePath) as data:
+        if int(data["version"]) != INVERTED_LIST_VERSION:
+            raise Exception(f"Invalid inverted list: version {int(data['version'])} is not supported (expected {INVERTED_LIST_VERSION}).")
+        terms, termOffsets, documentIDs = data["terms"], data["termOffsets"], data["documentIDs"]
+        documentGaps, termCounts = data["documentGaps"].astype(np.int64), data["termCounts"]
+
+    # Undoing the delta encoding: a running sum restarted at every term
+    termLengths = np.diff(termOffsets)
+    runningSum = np.cumsum(documentGaps)
+    termStarts = termOffsets[:-1][termLengths > 0]
+    restart = np.repeat(runningSum[termStarts] - documentGaps[termStarts], termLengths[termLengths > 0])
+    documentOrdinals = runningSum - restart
+
+    return pd.DataFrame({
+        "term": np.repeat(terms, termLengths),
+        "documentID": documentIDs[documentOrdinals],
+        "termCount": termCounts.astype(np.int64)
+    })
+
+class IndexSegments:
+    # Append-only index segments kept in a directory: every run of the
+    # InvertedListGenerator that finds new document files stores their
+    # postings as a new segment (a compact inverted list), and a manifest
+    # records which files (by size and modification time) each segment came
+    # from. As in a log merge policy, whenever mergeFactor segments reach the
+    # same size level (log base mergeFactor of the number of postings), they
+    # are merged into one. Changed or removed files, or different settings,
+    # discard the segments, since they can not be removed from an index
+    MANIFEST_FILE_NAME = "segments.json"
+    SEGMENTS_VERSION = 1
+
+    def __init__(self, segmentsDirPath: Text, mergeFactor: int = 10):
+        self.segmentsDirPath = segmentsDirPath
+        self.mergeFactor = mergeFactor
+        self.manifest = None
+
+    def getManifestFilePath(self) -> Text:
+        return os.path.join(self.segmentsDirPath, self.MANIFEST_FILE_NAME)
+
+    def getSegmentFilePath(self, segment) -> Text:
+        return os.path.join(self.segmentsDirPath, segment["name"])
+
+    def getSourceStats(self, documentFilePath: Text):
+        stats = os.stat(documentFilePath)
+        return {"size": stats.st_size, "mtime": stats.st_mtime_ns}
+
+    def loadManifest(self, settings):
+        manifestFilePath = self.getManifestFilePath()
+        if os.path.exists(manifestFilePath):
+            with open(manifestFilePath) as f:
+                manifest = json.load(f)
+            if manifest["version"] == self.SEGMENTS_VERSION and manifest["settings"] == settings:
+                return manifest
+            # The segments built with other settings are deleted, otherwise
+            # they would be left behind or overwritten as new segments
+            self.manifest = manifest
+            self.clear(settings)
+            return self.manifest
+        return {"version": self.SEGMENTS_VERSION, "settings": settings, "sources": {}, "segments": [], "nextSegment": 0}
+
+    def storeManifest(self):
+        manifestFilePath = self.getManifestFilePath()
+        with open(f"{manifestFilePath}.tmp", "w") as f:
+            json.dump(self.manifest, f, indent = 4)
+        os.replace(f"{manifestFilePath}.tmp", manifestFilePath)
+
+    def clear(self, settings):
+        for segment in self.manifest.get("segments", []):
+            if os.path.exists(self.getSegmentFilePath(segment)):
+                os.remove(self.getSegmentFilePath(segment))
+        self.manifest = {"version": self.SEGMENTS_VERSION, "settings": settings, "sources": {}, "segments": [], "nextSegment": 0}
+
+    def getNewDocumentFiles(self, documentFilePathList: List[Text], settings) -> List[Text]:
+        os.makedirs(self.segmentsDirPath, exist_ok = True)
+        self.manifest = self.loadManifest(settings)
+        sources = self.manifest["sources"]
+        isUpToDate = all(
+            path in documentFilePathList and self.getSourceStats(path) == stats
+            for path, stats in sources.items()
+        )
+        if not isUpToDate:
+            self.clear(settings)
+        return [path for path in documentFilePathList if path not in self.manifest["sources"]]
+
+    def storeSegment(self, invertedList: pd.DataFrame, sources: List[Text]):
+        segment = {"name": f"segment-{self.manifest['nextSegment']:06d}.npz", "sources": sources, "postings": len(invertedList)}
+        storeCompactInvertedList(self.getSegmentFilePath(segment), invertedList)
+        self.manifest["nextSegment"] += 1
+        return segment
+
+    def addSegment(self, invertedList: pd.DataFrame, documentFilePathList: List[Text]):
+        # The segment file is written before the manifest, so an interrupted
+        # run leaves at most an unreferenced file behind
+        if len(documentFilePathList) == 0:
+            return
+        if len(invertedList) > 0:
+            self.manifest["segments"].append(self.storeSegment(invertedList, documentFilePathList))
+        for path in documentFilePathList:
+            self.manifest["sources"][path] = self.getSourceStats(path)
+        self.mergeSegments()
+        self.storeManifest()
+
+    def getLevel(self, segment) -> int:
+        return int(np.log(max(segment["postings"], 1)) // np.log(self.mergeFactor))
+
+    def mergeSegments(self):
+        # Only runs of adjacent segments are merged, so the segments stay in
+        # the order their documents were added
+        segments = self.manifest["segments"]
+        start = 0
+        while start + self.mergeFactor <= len(segments):
+            merged = segments[start:start + self.mergeFactor]
+            if len(set(self.getLevel(segment) for segment in merged)) > 1:
+                start += 1
+                continue
+            invertedList = self.loadSegments(merged)
+            segment = self.storeSegment(invertedList, [path for segment in merged for path in segment["sources"]])
+            segments[start:start + self.mergeFactor] = [segment]
+            for segment in merged:
+                os.remove(self.getSegmentFilePath(segment))
+            start = 0
+
+    def loadSegments(self, segments = None) -> pd.DataFrame:
+        # Segments are concatenated in the order their documents were added
+        segments = self.manifest["segments"] if segments is None else segments
+        invertedLists = [loadCompactInvertedList(self.getSegmentFilePath(segment)) for segment in segments]
+        if len(invertedLists) == 0:
+            return pd.DataFrame({"term": [], "documentID": [], "termCount": []})
+        invertedList = pd.concat(invertedLists, ignore_index = True)
+        return invertedList.sort_values("term", kind = "stable", ignore_index = True)
+
+def isIndexableTerm(term: Text) -> bool:
+    # Only terms with 2 or more letters (and nothing else) are indexed
+    return term.isalpha() and len(term) >= 2
+
+def countDocumentTerms(documents, useStemmer = False, filterTerms = False):
+    # Partial inverted list of a chunk of (recordNum, abstract) pairs, mapping
+    # each term to its (recordNum, termCount) postings in document order. With
+    # filterTerms, the terms are already filtered and uppercased as the indexer does
+    textPipeline = getTextPipeline(useStemmer)
+    recordNums = [recordNum for recordNum, _ in documents]
+    abstracts = [abstract for _, abstract in documents]
+    termCounts = {}
+    for recordNum, tokens in zip(recordNums, textPipeline.vectorizeMany(abstracts)):
+        if filterTerms:
+            tokens = [token.upper() for token in tokens if isIndexableTerm(token)]
+        for term, termCount in Counter(tokens).items():
+            termCounts.setdefault(term, []).append((recordNum, termCount))
+    return termCounts
+
 class InvertedListGenerator:
     def __init__(
             self, 
             documentFilePathList: List[Text],
             invertedListFilePath: Text,
-            useStemmer: bool = False
+            useStemmer: bool = False,
+            numProcesses: int = 1,
+            filterTerms: bool = False,
+            segmentsDirPath: Text = None
         ):
         self.documentFilePathList = documentFilePathList
         self.invertedListFilePath = invertedListFilePath
+        # The extension is checked before any document is parsed
+        self.compactInvertedList = isCompactInvertedListFile(invertedListFilePath) if invertedListFilePath is not None else False
         self.useStemmer = useStemmer
+        self.numProcesses = numProcesses
+        self.filterTerms = filterTerms
+        self.segments = IndexSegments(segmentsDirPath) if segmentsDirPath is not None else None
+        self.newDocumentFilePathList = documentFilePathList
         self.documentsData = []
+        self.termCounts = []
+        self.numDocuments = 0
         self.logger = log.initLogger("INVERTED_LIST_GENERATOR")
 
-    def parseDocument(self, documentFilePath):
-        dataDOM = minidom.parse(documentFilePath)
-
-        data = []
-        
-        records = dataDOM.getElementsByTagName("RECORD")
-        for record in records:
-            recordNum = record.getElementsByTagName("RECORDNUM")[0].firstChild.data.strip()
-            abstract = record.getElementsByTagName("ABSTRACT")
-            extract = record.getElementsByTagName("EXTRACT")
-            if abstract != []:
-                abstract = abstract[0].firstChild.data
-            elif extract != []:
-                abstract = extract[0].firstChild.data
+    def iterDocument(self, documentFilePath):
+        # Yields the (recordNum, abstract) pair of each RECORD as soon as it is
+        # closed, and clears it afterwards, so no DOM of the file is built
+        context = ElementTree.iterparse(documentFilePath, events = ("start", "end"))
+        _, root = next(context)
+        for event, record in context:
+            if event != "end" or record.tag != "RECORD":
+                continue
+            recordNum = record.findtext("RECORDNUM").strip()
+            abstract = record.find("ABSTRACT")
+            extract = record.find("EXTRACT")
+            if abstract is not None:
+                abstract = abstract.text
+            elif extract is not None:
+                abstract = extract.text
             else: 
                 abstract = None
-            
-            data.append([recordNum, abstract])
 
-        return data
+            yield recordNum, abstract
+            root.clear()
 
-    def parseCorpus(self):
-        self.documentsData = []
-        for documentFilePath in self.documentFilePathList:
-            self.documentsData += self.parseDocument(documentFilePath)
-        self.documentsData = pd.DataFrame(self.documentsData, columns = ["recordNum", "abstract"])
+    def iterDocumentChunks(self):
+        # Chunks of DOCUMENT_CHUNK_SIZE records with text, in the order of the
+        # new document files
+        chunk = []
+        for documentFilePath in self.newDocumentFilePathList:
+            for recordNum, abstract in self.iterDocument(documentFilePath):
+                self.numDocuments += 1
+                if abstract is None:
+                    continue
+                chunk.append((recordNum, abstract))
+                if len(chunk) == DOCUMENT_CHUNK_SIZE:
+                    yield chunk
+                    chunk = []
+        if len(chunk) > 0:
+            yield chunk
 
     def preprocessDocuments(self):
-        self.documentsData = self.documentsData.dropna()
-        self.documentsData["abstract"] = self.documentsData["abstract"].apply(
-            lambda text: vectorizeText(text, self.useStemmer)
-        )
+        # The records are counted while the files are parsed, so only the
+        # postings are kept and the raw texts of at most a few chunks are in
+        # memory at a time
+        self.numDocuments = 0
+        self.termCounts = []
+        countTerms = partial(countDocumentTerms, useStemmer = self.useStemmer, filterTerms = self.filterTerms)
+        if self.numProcesses > 1:
+            with ProcessPoolExecutor(max_workers = self.numProcesses) as executor:
+                # Two chunks per process are submitted ahead of the oldest one
+                # and the results are collected in document order
+                futures = deque()
+                for chunk in self.iterDocumentChunks():
+                    futures.append(executor.submit(countTerms, chunk))
+                    if len(futures) >= 2*self.numProcesses:
+                        self.termCounts.append(futures.popleft().result())
+                self.termCounts.extend(future.result() for future in futures)
+        else:
+            self.termCounts = [countTerms(chunk) for chunk in self.iterDocumentChunks()]
 
     def generateInvertedList(self):
-        self.documentsData = self.documentsData.explode("abstract")
-        self.documentsData = self.documentsData.groupby("abstract").agg(lambda group: list(group)).reset_index()
-        self.documentsData.columns = ["term", "documentIDList"]
-        self.documentsData = self.documentsData.sort_values("term")
-        self.documentsData = self.documentsData.dropna()
+        # Chunks are merged in document order, so the inverted list does not
+        # depend on the number of processes
+        invertedList = {}
+        for chunkTermCounts in self.termCounts:
+            for term, postings in chunkTermCounts.items():
+                invertedList.setdefault(term, []).extend(postings)
+        self.termCounts = []
+
+        self.documentsData = pd.DataFrame(
+            data = [
+                (term, recordNum, termCount)
+                for term in sorted(invertedList)
+                for recordNum, termCount in invertedList[term]
+            ],
+            columns = ["term", "documentID", "termCount"]
+        )
+
+    def findNewDocumentFiles(self):
+        settings = {"useStemmer": self.useStemmer, "filterTerms": self.filterTerms}
+        self.newDocumentFilePathList = self.segments.getNewDocumentFiles(self.documentFilePathList, settings)
+
+    def updateSegments(self):
+        # Only the postings of the new documents are written, and the inverted
+        # list of the whole collection is read back from the segments
+        self.segments.addSegment(self.documentsData, self.newDocumentFilePathList)
+        self.documentsData = self.segments.loadSegments()
 
     def storeInvertedList(self):
-        self.documentsData.to_csv(self.invertedListFilePath, index = False, sep = ";")
+        if self.compactInvertedList:
+            storeCompactInvertedList(self.invertedListFilePath, self.documentsData)
+        else:
+            # Text layout: one row per term listing its document IDs once per occurrence
+            invertedList = self.documentsData.loc[self.documentsData.index.repeat(self.documentsData.termCount)]
+            invertedList = invertedList.groupby("term", sort = False).documentID.agg(list).reset_index()
+            invertedList.columns = ["term", "documentIDList"]
+            invertedList.to_csv(self.invertedListFilePath, index = False, sep = ";")
 
     def _run(self):
-        log.executeFunction(
-            logger = self.logger, 
-            onStartMessage = "Loading documents",
-            onFinishMessage = "Documents were loaded with success",
-            onErrorMessage = "Error while loading documents",
-            func = self.parseCorpus
-        )
-        self.logger.info(f"Total Documents: {self.documentsData.shape[0]}")
+        if self.segments is not None:
+            log.executeFunction(
+                logger = self.logger, 
+                onStartMessage = "Looking for new document files",
+                onFinishMessage = "New document files were found with success",
+                onErrorMessage = "Error while looking for new document files",
+                func = self.findNewDocumentFiles
+            )
+            self.logger.info(f"New Document Files: {len(self.newDocumentFilePathList)} of {len(self.documentFilePathList)}")
 
         log.executeFunction(
             logger = self.logger, 
-            onStartMessage = "Preprocessing documents",
-            onFinishMessage = "Documents were preprocessed with success",
-            onErrorMessage = "Error while preprocessing documents",
+            onStartMessage = "Loading and preprocessing documents",
+            onFinishMessage = "Documents were loaded and preprocessed with success",
+            onErrorMessage = "Error while loading and preprocessing documents",
             func = self.preprocessDocuments
         )
+        self.logger.info(f"Total Documents: {self.numDocuments}")
 
         log.executeFunction(
             logger = self.logger, 
@@ -97,68 +356,101 @@ class InvertedListGenerator:
             onErrorMessage = "Error while generating inverted list",
             func = self.generateInvertedList
         )
-        self.logger.info(f"Total Terms: {self.documentsData.shape[0]}")
 
-        log.executeFunction(
-            logger = self.logger, 
-            onStartMessage = "Storing inverted list",
-            onFinishMessage = "Inverted list was stored with success",
-            onErrorMessage = "Error while storing inverted list",
-            func = self.storeInvertedList
-        )
+        if self.segments is not None:
+            log.executeFunction(
+                logger = self.logger, 
+                onStartMessage = "Updating index segments",
+                onFinishMessage = "Index segments were updated with success",
+                onErrorMessage = "Error while updating index segments",
+                func = self.updateSegments
+            )
+            self.logger.info(f"Total Segments: {len(self.segments.manifest['segments'])}")
+        self.logger.info(f"Total Terms: {self.documentsData.term.nunique()}")
+
+        if self.invertedListFilePath is not None:
+            log.executeFunction(
+                logger = self.logger, 
+                onStartMessage = "Storing inverted list",
+                onFinishMessage = "Inverted list was stored with success",
+                onErrorMessage = "Error while storing inverted list",
+                func = self.storeInvertedList
+            )
+
+        return self.documentsData
 
     def run(self):
-        log.executeModule(self.logger, self._run)
+        return log.executeModule(self.logger, self._run)
 
 class Indexer:
     def __init__(
         self, 
         invertedListFilePath: Text,
-        indexesFilePath: Text
+        indexesFilePath: Text,
+        numShards: int = 1,
+        compressPostings: bool = False
     ):
         self.invertedListFilePath = invertedListFilePath
+        self.compactInvertedList = isCompactInvertedListFile(invertedListFilePath) if invertedListFilePath is not None else False
         self.indexesFilePath = indexesFilePath
+        self.numShards = numShards
+        self.compressPostings = compressPostings
         self.logger = log.initLogger("INDEXER")
 
     def processInvertedList(self) -> pd.DataFrame:
-        # Generating Statistics
-        invertedList = pd.read_csv(self.invertedListFilePath, sep = ";").dropna()
-        invertedList.documentIDList = invertedList.documentIDList.apply(ast.literal_eval)
-
-        invertedList["documentCount"] = invertedList.documentIDList.apply(len)
-        invertedList.documentIDList = invertedList.documentIDList.apply(
-            lambda documents: pd.DataFrame(
-                data = pd.Series(documents).value_counts().to_dict().items(),
-                columns = ["documentID", "termCount"]
-            ).set_index("documentID")
-        )
-        invertedList = invertedList.set_index("term")
+        # Loading the (term, documentID, termCount) postings
+        if self.compactInvertedList:
+            invertedList = loadCompactInvertedList(self.invertedListFilePath)
+        else:
+            invertedList = pd.read_csv(self.invertedListFilePath, sep = ";").dropna()
+            invertedList.documentIDList = invertedList.documentIDList.str.findall(r"'([^']*)'")
+            invertedList = invertedList.explode("documentIDList").rename(columns = {"documentIDList": "documentID"})
+            invertedList = invertedList.groupby(["term", "documentID"]).size().rename("termCount").reset_index()
         
         # Preprocessing the terms
-        ## Filtering terms with only letters
-        invertedList = invertedList[pd.Series(invertedList.index).apply(lambda term: term.isalpha()).values]
+        terms = invertedList.term.astype(str)
 
-        ## Filtering terms with 2 or more letters
-        invertedList = invertedList[(pd.Series(invertedList.index).apply(len) >= 2).values]
+        ## Filtering terms with only letters and 2 or more letters
+        invertedList = invertedList[terms.map(isIndexableTerm).values]
 
         ## Uppercasing terms
-        invertedList.index = pd.Series(invertedList.index).apply(str.upper)
+        invertedList = invertedList.assign(term = invertedList.term.str.upper())
+        invertedList = invertedList.groupby(["term", "documentID"], as_index = False).termCount.sum()
 
         return invertedList
     
     def createTermDocumentMatrix(self, invertedList):
-        termDocumentMatrix = TermDocumentMatrix(invertedList = invertedList, weightCalculator = StandardTFIDF)
-        pickle.dump(termDocumentMatrix, open(self.indexesFilePath, "wb"))
+        if self.numShards > 1:
+            termDocumentMatrix = ShardedTermDocumentMatrix.create(invertedList, numShards = self.numShards, weightCalculator = StandardTFIDF)
+        else:
+            termDocumentMatrix = TermDocumentMatrix(invertedList = invertedList, weightCalculator = StandardTFIDF)
+        if self.compressPostings:
+            termDocumentMatrix.compressPostings()
+            self.logCompressionStats(termDocumentMatrix.getPostingsCompressionStats())
+        termDocumentMatrix.store(self.indexesFilePath)
 
-    def _run(self):
-        processedInvertedList = log.executeFunction(
-            logger = self.logger, 
-            onStartMessage = "Loading and processing inverted list",
-            onFinishMessage = "Inverted list was loaded and processed with success",
-            onErrorMessage = "Error while loading and processing inverted list",
-            func = self.processInvertedList
+    def logCompressionStats(self, stats):
+        ratio = stats["rawBytes"] / max(stats["compressedBytes"], 1)
+        throughput = stats["postings"] / max(stats["decodeTime"], 1e-9)
+        self.logger.info(
+            f"Postings compression: {stats['rawBytes']/2**20:.2f} MB -> {stats['compressedBytes']/2**20:.2f} MB "
+            f"(ratio {ratio:.2f}), decode throughput {throughput/1e6:.1f}M postings/s"
         )
-        self.logger.info(f"Total Terms: {processedInvertedList.shape[0]}")
+
+    def _run(self, invertedList: pd.DataFrame = None):
+        # An inverted list handed over in memory was already filtered while
+        # the documents were tokenized (see InvertedListGenerator.filterTerms)
+        if invertedList is not None:
+            processedInvertedList = invertedList
+        else:
+            processedInvertedList = log.executeFunction(
+                logger = self.logger, 
+                onStartMessage = "Loading and processing inverted list",
+                onFinishMessage = "Inverted list was loaded and processed with success",
+                onErrorMessage = "Error while loading and processing inverted list",
+                func = self.processInvertedList
+            )
+        self.logger.info(f"Total Terms: {processedInvertedList.term.nunique()}")
 
         log.executeFunction(
             logger = self.logger, 
@@ -169,5 +461,5 @@ class Indexer:
             invertedList = processedInvertedList
         )
         
-    def run(self):
-        log.executeModule(self.logger, self._run)
\ No newline at end of file
+    def run(self, invertedList: pd.DataFrame = None):
+        log.executeModule(self.logger, self._run, invertedList = invertedList)
\ No newline at end of file
@@ -1,21 +1,421 @@
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+from scipy import sparse
+from utils import weight
 from utils.weight import WeightCalculator, StandardTFIDF
-from typing import List, Dict
+from typing import List, Dict, Text, Tuple
+
+# Model file layout: MODEL_MAGIC, the format version and the header length as
+# little-endian uint32, a JSON header and then the flat arrays, each one
+# starting at a multiple of MODEL_ALIGNMENT bytes
+MODEL_MAGIC = b"BMTMODEL"
+MODEL_VERSION = 6
+MODEL_ALIGNMENT = 64
+
+# A sharded model is a JSON manifest listing the model file of each shard
+# (relative to the manifest), which all hold weights computed with the
+# statistics of the whole collection
+SHARDED_MODEL_VERSION = 1
+SHARDED_MODEL_KEYS = ["version", "contentHash", "shards"]
+
+# Models of older versions were pickled, and pickle protocols 2 and above
+# start with this opcode
+PICKLE_PROTOCOL_OPCODE = b"\x80"
+
+def kthLargest(values: np.ndarray, k: int) -> float:
+    if len(values) < k:
+        return -np.inf
+    return np.partition(values, len(values) - k)[len(values) - k]
+
+def rankDocuments(candidates: np.ndarray, scores: np.ndarray, limit = None, threshold = None) -> Tuple[np.ndarray, np.ndarray]:
+    # Sorts by descending score with ties broken by document ordinal. With a
+    # limit or a threshold, the candidates that can not be returned are
+    # dropped before sorting
+    if threshold is not None:
+        keep = scores >= threshold
+        candidates, scores = candidates[keep], scores[keep]
+    if limit is not None and limit < len(candidates):
+        keep = scores >= kthLargest(scores, limit)
+        candidates, scores = candidates[keep], scores[keep]
+    order = np.lexsort((candidates, -scores))[:limit]
+    return candidates[order], scores[order]
 
 class TermDocumentMatrix:
-    def __init__(self, invertedList: List[Dict], weightCalculator: WeightCalculator = StandardTFIDF):
-        self.invertedList = invertedList
-        self.weightCalculator = weightCalculator(invertedList)
+    def __init__(self, invertedList: pd.DataFrame, weightCalculator: WeightCalculator = StandardTFIDF, collectionStatistics: Dict = None):
+        if collectionStatistics is None:
+            self.weightCalculator = weightCalculator(invertedList)
+        else:
+            self.weightCalculator = weightCalculator(invertedList, collectionStatistics = collectionStatistics)
+        self.documentIDs = self.weightCalculator.documentIDs
+        self.contentHash = None
+
+    def getPostings(self, term) -> Tuple[np.ndarray, np.ndarray]:
+        # Document ordinals (positions in self.documentIDs) and normalized
+        # weights of the postings of a term, as views over the model arrays
+        return self.getTermPostings(self.weightCalculator.getTermOrdinal(term))
+
+    def getTermPostings(self, termOrdinal) -> Tuple[np.ndarray, np.ndarray]:
+        weightCalculator = self.weightCalculator
+        start, end = weightCalculator.termOffsets[termOrdinal], weightCalculator.termOffsets[termOrdinal + 1]
+        documentOrdinals, _ = weightCalculator.getTermPostingData(termOrdinal)
+        return documentOrdinals, weightCalculator.normalizedWeights[start:end]
+
+    def compressPostings(self):
+        self.weightCalculator.compressPostings()
+
+    def getPostingsCompressionStats(self):
+        return self.weightCalculator.getPostingsCompressionStats()
 
     def getWeight(self, documentID, term, normalized = False):
         weight = self.weightCalculator.getWeight(documentID, term, normalized)
         return weight
 
     def filterQueryTerms(self, queryTerms) -> List:
-        queryTerms = set(queryTerms)
-        vocabulary = set(self.invertedList.index)
-        return list(queryTerms.intersection(vocabulary))
+        # Unique terms in query order, so every shard scores them in the same order
+        queryTerms = dict.fromkeys(queryTerms)
+        return [term for term in queryTerms if self.weightCalculator.getTermOrdinal(term) is not None]
 
     def filterDocumentsByQueryTerms(self, queryTerms) -> List:
-        documentIDs = self.invertedList.loc[queryTerms].documentIDList.apply(lambda document: list(document.index))
-        documentIDs = documentIDs.explode().unique()
-        return documentIDs
\ No newline at end of file
+        ordinals = np.unique(np.concatenate([self.getPostings(term)[0] for term in queryTerms]))
+        return self.documentIDs[ordinals]
+
+    def scoreQueryTerms(self, queryTerms, limit = None, threshold = None) -> Tuple[np.ndarray, np.ndarray]:
+        if limit is not None:
+            return self.scoreQueryTermsTopK(queryTerms, limit, threshold)
+
+        # Term-at-a-time scoring: every posting list is walked once and its
+        # weights are added into an accumulator indexed by document ordinal
+        accumulator = np.zeros(len(self.documentIDs), dtype = np.float64)
+        matched = np.zeros(len(self.documentIDs), dtype = bool)
+        for term in queryTerms:
+            ordinals, weights = self.getPostings(term)
+            accumulator[ordinals] += weights
+            matched[ordinals] = True
+
+        candidates = np.flatnonzero(matched)
+        candidates, scores = rankDocuments(candidates, accumulator[candidates], threshold = threshold)
+        return self.documentIDs[candidates], scores
+
+    def scoreQueryTermsTopK(self, queryTerms, limit, threshold = None) -> Tuple[np.ndarray, np.ndarray]:
+        # MaxScore: terms are visited by decreasing upper bound (the largest
+        # normalized weight of the term). Once the upper bounds of the terms
+        # left cannot lift an unseen document up to the current k-th score,
+        # no new document is admitted and the remaining postings are only
+        # probed, by binary search, for the documents still in contention. A
+        # similarity threshold is just an initial value for the k-th score
+        weightCalculator = self.weightCalculator
+        termOrdinals = np.array([weightCalculator.getTermOrdinal(term) for term in queryTerms], dtype = np.int64)
+        upperBounds = weightCalculator.maxNormalizedWeights[termOrdinals].astype(np.float64)
+        order = np.argsort(-upperBounds, kind = "stable")
+        termOrdinals, upperBounds = termOrdinals[order], upperBounds[order]
+        remainingUpperBounds = np.append(np.cumsum(upperBounds[::-1])[::-1], 0)
+
+        accumulator = np.zeros(len(self.documentIDs), dtype = np.float64)
+        matched = np.zeros(len(self.documentIDs), dtype = bool)
+        kthScore = -np.inf if threshold is None else threshold
+        i = 0
+        while i < len(termOrdinals) and remainingUpperBounds[i] >= kthScore:
+            ordinals, weights = self.getTermPostings(termOrdinals[i])
+            accumulator[ordinals] += weights
+            matched[ordinals] = True
+            # The k-th best partial score among the documents just updated is
+            # already a lower bound of the final k-th score
+            kthScore = max(kthScore, kthLargest(accumulator[ordinals], limit))
+            i += 1
+
+        candidates = np.flatnonzero(matched)
+        for j in range(i, len(termOrdinals)):
+            candidates = candidates[accumulator[candidates] + remainingUpperBounds[j] >= kthScore]
+            ordinals, weights = self.getTermPostings(termOrdinals[j])
+            positions = np.minimum(np.searchsorted(ordinals, candidates), len(ordinals) - 1)
+            found = ordinals[positions] == candidates
+            accumulator[candidates[found]] += weights[positions[found]]
+            kthScore = max(kthScore, kthLargest(accumulator[candidates], limit))
+
+        candidates, scores = rankDocuments(candidates, accumulator[candidates], limit, threshold)
+        return self.documentIDs[candidates], scores
+
+    def getWeightMatrix(self) -> sparse.csr_matrix:
+        # Term x document matrix of normalized weights over the CSR arrays
+        weightCalculator = self.weightCalculator
+        return sparse.csr_matrix(
+            (weightCalculator.normalizedWeights, weightCalculator.getDocumentOrdinals(), weightCalculator.termOffsets),
+            shape = (len(weightCalculator.terms), len(self.documentIDs))
+        )
+
+    def scoreQueryTermsBatch(self, queryTermsList, limit = None, threshold = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        # All queries are encoded as a sparse query x term matrix and scored
+        # with one sparse product against the weight matrix. Documents whose
+        # similarity is exactly zero are dropped by the sparse product
+        termOrdinals = [[self.weightCalculator.getTermOrdinal(term) for term in queryTerms] for queryTerms in queryTermsList]
+        queryOffsets = np.zeros(len(termOrdinals) + 1, dtype = np.int64)
+        queryOffsets[1:] = np.cumsum([len(ordinals) for ordinals in termOrdinals])
+        queryTermMatrix = sparse.csr_matrix(
+            (np.ones(queryOffsets[-1]), np.array([o for ordinals in termOrdinals for o in ordinals], dtype = np.int64), queryOffsets),
+            shape = (len(termOrdinals), len(self.weightCalculator.terms))
+        )
+        similarities = (queryTermMatrix @ self.getWeightMatrix()).tocsr()
+        if threshold is not None:
+            similarities.data[similarities.data < threshold] = 0
+            similarities.eliminate_zeros()
+
+        # Ranking every row at once: by query, descending score and document ordinal
+        queries = np.repeat(np.arange(len(termOrdinals)), np.diff(similarities.indptr))
+        order = np.lexsort((similarities.indices, -similarities.data, queries))
+        ranks = np.arange(len(order)) - similarities.indptr[queries] + 1
+        candidates, scores = similarities.indices[order], similarities.data[order]
+        if limit is not None:
+            keep = ranks <= limit
+            queries, ranks, candidates, scores = queries[keep], ranks[keep], candidates[keep], scores[keep]
+        return queries, ranks, self.documentIDs[candidates], scores
+
+    def store(self, modelFilePath: Text):
+        arrays = {}
+        attributes = {}
+        for name, value in vars(self.weightCalculator).items():
+            if isinstance(value, np.ndarray):
+                arrays[name] = np.ascontiguousarray(value)
+            elif isinstance(value, (np.integer, np.floating)):
+                attributes[name] = value.item()
+            else:
+                attributes[name] = value
+
+        # The content hash identifies the model data regardless of the file
+        # path, so anything derived from a model (e.g. cached query results)
+        # can tell when the model was rebuilt
+        contentHash = hashlib.sha256(json.dumps(
+            [type(self.weightCalculator).__name__, attributes], sort_keys = True
+        ).encode("utf-8"))
+        for name, array in arrays.items():
+            contentHash.update(json.dumps([name, array.dtype.str, array.shape]).encode("utf-8"))
+            contentHash.update(array.data)
+        self.contentHash = contentHash.hexdigest()
+
+        header = {
+            "weightCalculator": type(self.weightCalculator).__name__,
+            "contentHash": self.contentHash,
+            "attributes": attributes,
+            "arrays": {}
+        }
+        # The array offsets are relative to the end of the header, so they do
+        # not depend on the header length
+        offset = 0
+        for name, array in arrays.items():
+            header["arrays"][name] = {"dtype": array.dtype.str, "shape": array.shape, "offset": offset}
+            offset += -(-array.nbytes // MODEL_ALIGNMENT) * MODEL_ALIGNMENT
+
+        headerBytes = json.dumps(header).encode("utf-8")
+        headerLength = len(MODEL_MAGIC) + 8 + len(headerBytes)
+        headerBytes += b" " * (-headerLength % MODEL_ALIGNMENT)
+
+        with open(modelFilePath, "wb") as f:
+            f.write(MODEL_MAGIC)
+            f.write(np.array([MODEL_VERSION, len(headerBytes)], dtype = "<u4").tobytes())
+            f.write(headerBytes)
+            for name, array in arrays.items():
+                f.write(array.tobytes())
+                f.write(b"\0" * (-array.nbytes % MODEL_ALIGNMENT))
+
+    @classmethod
+    def load(cls, modelFilePath: Text, mmap: bool = True):
+        with open(modelFilePath, "rb") as f:
+            magic = f.read(len(MODEL_MAGIC))
+            if magic != MODEL_MAGIC:
+                raise Exception(f"Invalid model file: {modelFilePath} is not a model file.")
+            version, headerLength = np.frombuffer(f.read(8), dtype = "<u4")
+            if version != MODEL_VERSION:
+                raise Exception(f"Invalid model file: version {version} is not supported (expected {MODEL_VERSION}).")
+            header = json.loads(f.read(headerLength).decode("utf-8"))
+
+        # Every array is a view over a single read-only mapping of the file, so
+        # nothing is deserialized and the pages are shared between processes
+        dataOffset = len(MODEL_MAGIC) + 8 + int(headerLength)
+        if mmap:
+            buffer = np.memmap(modelFilePath, dtype = np.uint8, mode = "r")
+        else:
+            buffer = np.fromfile(modelFilePath, dtype = np.uint8)
+
+        attributes = dict(header["attributes"])
+        for name, description in header["arrays"].items():
+            dtype = np.dtype(description["dtype"])
+            shape = tuple(description["shape"])
+            start = dataOffset + description["offset"]
+            end = start + dtype.itemsize * int(np.prod(shape))
+            attributes[name] = buffer[start:end].view(dtype).reshape(shape)
+
+        weightCalculatorClass = getattr(weight, header["weightCalculator"])
+        termDocumentMatrix = cls.__new__(cls)
+        termDocumentMatrix.weightCalculator = weightCalculatorClass.fromAttributes(attributes)
+        termDocumentMatrix.documentIDs = termDocumentMatrix.weightCalculator.documentIDs
+        termDocumentMatrix.contentHash = header["contentHash"]
+        return termDocumentMatrix
+
+class ShardedTermDocumentMatrix:
+    # Document-partitioned model: each shard is a TermDocumentMatrix over a
+    # range of documents, and the results of the shards are merged by score
+    # and document ID. Since the documents of a shard keep their relative
+    # order and weights, the merge gives the same ranking as a single model.
+    # With more than one process and shard files, every query is scattered
+    # to a pool of workers that score one shard each and gathered back here
+    def __init__(self, shards: List[TermDocumentMatrix], shardFilePaths: List[Text] = None, numProcesses: int = 1):
+        self.shards = shards
+        self.shardFilePaths = shardFilePaths
+        self.numProcesses = numProcesses
+        self.executor = None
+        self.contentHash = hashlib.sha256("".join(shard.contentHash or "" for shard in shards).encode("utf-8")).hexdigest()
+
+    @classmethod
+    def create(cls, invertedList, numShards: int, weightCalculator: WeightCalculator = StandardTFIDF):
+        collectionStatistics = weight.calculateCollectionStatistics(invertedList)
+        documentIDs = np.unique(invertedList.documentID.to_numpy().astype(str))
+        numShards = max(1, min(numShards, len(documentIDs)))
+        shardOrdinals = np.searchsorted(documentIDs, invertedList.documentID.to_numpy().astype(str)) * numShards // len(documentIDs)
+        shards = [
+            TermDocumentMatrix(invertedList[shardOrdinals == shard], weightCalculator, collectionStatistics)
+            for shard in range(numShards)
+        ]
+        return cls(shards)
+
+    def compressPostings(self):
+        for shard in self.shards:
+            shard.compressPostings()
+
+    def getPostingsCompressionStats(self):
+        shardStats = [shard.getPostingsCompressionStats() for shard in self.shards]
+        return {name: sum(stats[name] for stats in shardStats) for name in shardStats[0]}
+
+    def getShard(self, documentID) -> TermDocumentMatrix:
+        for shard in self.shards:
+            if shard.weightCalculator.getDocumentOrdinal(documentID) is not None:
+                return shard
+        raise Exception(f"Invalid document ID: the document {documentID} does not exist.")
+
+    def getWeight(self, documentID, term, normalized = False):
+        return self.getShard(documentID).getWeight(documentID, term, normalized)
+
+    def filterQueryTerms(self, queryTerms) -> List:
+        queryTerms = dict.fromkeys(queryTerms)
+        return [term for term in queryTerms if any(shard.weightCalculator.getTermOrdinal(term) is not None for shard in self.shards)]
+
+    def isParallel(self) -> bool:
+        return self.numProcesses > 1 and self.shardFilePaths is not None and len(self.shards) > 1
+
+    def getExecutor(self) -> ProcessPoolExecutor:
+        # The pool outlives each query, so the workers map their shard files
+        # once instead of once per query
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers = min(self.numProcesses, len(self.shards)))
+        return self.executor
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def scoreQueryTerms(self, queryTerms, limit = None, threshold = None) -> Tuple[np.ndarray, np.ndarray]:
+        # Each shard returns its own top k, so the top k of their union is exact
+        if self.isParallel():
+            shardResults = list(self.getExecutor().map(
+                scoreShardQueryTerms, self.shardFilePaths, repeat(queryTerms), repeat(limit), repeat(threshold)
+            ))
+        else:
+            shardResults = [
+                scoreTermDocumentMatrix(shard, queryTerms, limit, threshold) for shard in self.shards
+            ]
+        documentIDs = np.concatenate([documentIDs for documentIDs, scores in shardResults])
+        scores = np.concatenate([scores for documentIDs, scores in shardResults])
+        order = np.lexsort((documentIDs, -scores))[:limit]
+        return documentIDs[order], scores[order]
+
+    def scoreQueryTermsBatch(self, queryTermsList, limit = None, threshold = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        if self.isParallel():
+            shardResults = list(self.getExecutor().map(
+                scoreShardQueryTermsBatch, self.shardFilePaths, repeat(queryTermsList), repeat(limit), repeat(threshold)
+            ))
+        else:
+            shardResults = [
+                scoreTermDocumentMatrixBatch(shard, queryTermsList, limit, threshold) for shard in self.shards
+            ]
+
+        queries, _, documentIDs, scores = [np.concatenate(arrays) for arrays in zip(*shardResults)]
+        order = np.lexsort((documentIDs, -scores, queries))
+        queries, documentIDs, scores = queries[order], documentIDs[order], scores[order]
+        queryStarts = np.searchsorted(queries, np.arange(len(queryTermsList)))
+        ranks = np.arange(len(queries)) - queryStarts[queries] + 1
+        if limit is not None:
+            keep = ranks <= limit
+            queries, ranks, documentIDs, scores = queries[keep], ranks[keep], documentIDs[keep], scores[keep]
+        return queries, ranks, documentIDs, scores
+
+    def store(self, modelFilePath: Text):
+        shardFilePathBase, extension = os.path.splitext(modelFilePath)
+        self.shardFilePaths = [f"{shardFilePathBase}-shard{shard}{extension}" for shard in range(len(self.shards))]
+        for shard, shardFilePath in zip(self.shards, self.shardFilePaths):
+            shard.store(shardFilePath)
+        self.contentHash = hashlib.sha256("".join(shard.contentHash for shard in self.shards).encode("utf-8")).hexdigest()
+
+        manifest = {
+            "version": SHARDED_MODEL_VERSION,
+            "contentHash": self.contentHash,
+            "shards": [os.path.basename(shardFilePath) for shardFilePath in self.shardFilePaths]
+        }
+        with open(modelFilePath, "w") as f:
+            json.dump(manifest, f, indent = 4)
+
+    @classmethod
+    def load(cls, modelFilePath: Text, mmap: bool = True, numProcesses: int = 1):
+        try:
+            with open(modelFilePath, encoding = "utf-8") as f:
+                manifest = json.load(f)
+        except (UnicodeDecodeError, json.JSONDecodeError):
+            raise Exception(f"Invalid sharded model file: {modelFilePath} is not a JSON manifest.")
+        if not isinstance(manifest, dict) or any(key not in manifest for key in SHARDED_MODEL_KEYS):
+            raise Exception(f"Invalid sharded model file: {modelFilePath} should have the keys {', '.join(SHARDED_MODEL_KEYS)}.")
+        if manifest["version"] != SHARDED_MODEL_VERSION:
+            raise Exception(f"Invalid sharded model file: version {manifest['version']} is not supported (expected {SHARDED_MODEL_VERSION}).")
+        modelDirPath = os.path.dirname(modelFilePath)
+        shardFilePaths = [os.path.join(modelDirPath, shardFileName) for shardFileName in manifest["shards"]]
+        shards = [TermDocumentMatrix.load(shardFilePath, mmap = mmap) for shardFilePath in shardFilePaths]
+        return cls(shards, shardFilePaths = shardFilePaths, numProcesses = numProcesses)
+
+def isShardedModelFile(modelFilePath: Text) -> bool:
+    with open(modelFilePath, "rb") as f:
+        magic = f.read(len(MODEL_MAGIC))
+    if magic == MODEL_MAGIC:
+        return False
+    if magic.startswith(PICKLE_PROTOCOL_OPCODE):
+        raise Exception(f"Invalid model file: {modelFilePath} is a legacy pickled model, which should be rebuilt with the Indexer.")
+    if not magic.lstrip().startswith(b"{"):
+        raise Exception(f"Invalid model file: {modelFilePath} is neither a model file nor a sharded model manifest.")
+    return True
+
+def loadModel(modelFilePath: Text, mmap: bool = True, numProcesses: int = 1):
+    if isShardedModelFile(modelFilePath):
+        return ShardedTermDocumentMatrix.load(modelFilePath, mmap = mmap, numProcesses = numProcesses)
+    return TermDocumentMatrix.load(modelFilePath, mmap = mmap)
+
+def scoreTermDocumentMatrix(termDocumentMatrix: TermDocumentMatrix, queryTerms, limit = None, threshold = None):
+    return termDocumentMatrix.scoreQueryTerms(termDocumentMatrix.filterQueryTerms(queryTerms), limit = limit, threshold = threshold)
+
+def scoreTermDocumentMatrixBatch(termDocumentMatrix: TermDocumentMatrix, queryTermsList, limit = None, threshold = None):
+    queryTermsList = [termDocumentMatrix.filterQueryTerms(queryTerms) for queryTerms in queryTermsList]
+    return termDocumentMatrix.scoreQueryTermsBatch(queryTermsList, limit = limit, threshold = threshold)
+
+# Shard files mapped by this process when it is a scatter-gather worker
+shardWorkerModels = {}
+
+def getShardWorkerModel(modelFilePath: Text) -> TermDocumentMatrix:
+    if modelFilePath not in shardWorkerModels:
+        shardWorkerModels[modelFilePath] = TermDocumentMatrix.load(modelFilePath)
+    return shardWorkerModels[modelFilePath]
+
+def scoreShardQueryTerms(modelFilePath: Text, queryTerms, limit = None, threshold = None):
+    return scoreTermDocumentMatrix(getShardWorkerModel(modelFilePath), queryTerms, limit, threshold)
+
+def scoreShardQueryTermsBatch(modelFilePath: Text, queryTermsList, limit = None, threshold = None):
+    return scoreTermDocumentMatrixBatch(getShardWorkerModel(modelFilePath), queryTermsList, limit, threshold)
@@ -8,7 +8,7 @@ import sys
 sys.path.append(PROJECT_DIR)
 
 from typing import Text
-from xml.dom import minidom
+from xml.etree import ElementTree
 from utils.textProcessing import textPreprocessingFunc
 from utils import log
 
@@ -25,27 +25,30 @@ class QueryProcessor:
         self.queries = None
         self.logger = log.initLogger("QUERY_PROCESSOR")
     
-    def parseQueries(self):
-        dataDOM = minidom.parse(self.queriesFilePath)
-
-        columns = ["queryNumber", "queryText", "queryResults"]
-        data = []
-
-        queries = dataDOM.getElementsByTagName("QUERY")
-        for query in queries:
-            queryNumber = query.getElementsByTagName("QueryNumber")[0].firstChild.data
-            queryText = query.getElementsByTagName("QueryText")[0].firstChild.data
+    def iterQueries(self):
+        # Yields each QUERY as soon as it is closed and clears it afterwards;
+        # the queries file is small, so parseQueries keeps all of them
+        context = ElementTree.iterparse(self.queriesFilePath, events = ("start", "end"))
+        _, root = next(context)
+        for event, query in context:
+            if event != "end" or query.tag != "QUERY":
+                continue
+            queryNumber = query.findtext("QueryNumber")
+            queryText = query.findtext("QueryText")
             queryResults = [
                 {
-                    "resultDoc": resultItem.firstChild.data,
-                    "resultScores": resultItem.getAttribute("score") 
-                } for resultItem in query.getElementsByTagName("Item")
+                    "resultDoc": resultItem.text,
+                    "resultScores": resultItem.get("score", "")
+                } for resultItem in query.iter("Item")
             ]
-            data.append([queryNumber, queryText, queryResults])
 
-        self.queries = pd.DataFrame(data = data, columns = columns)
+            yield queryNumber, queryText, queryResults
+            root.clear()
+
+    def parseQueries(self):
+        columns = ["queryNumber", "queryText", "queryResults"]
+        self.queries = pd.DataFrame(data = self.iterQueries(), columns = columns)
 
-    
     def preprocessQueries(self):
         self.queries.loc[:, "queryText"] = self.queries.loc[:, "queryText"].apply(textPreprocessingFunc)
 
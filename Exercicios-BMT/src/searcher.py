@@ -5,13 +5,16 @@ PROJECT_DIR = os.path.normpath(f"{SCRIPT_DIR}/..")
 import sys
 sys.path.append(PROJECT_DIR)
 
-import pickle
 import numpy as np
 import pandas as pd
 from typing import Text, List
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
 from utils.textProcessing import vectorizeText
+from src.model import loadModel, ShardedTermDocumentMatrix
 from utils import log
+from utils.cache import QueryResultCache
 
 class Searcher:
     def __init__(
@@ -19,59 +22,122 @@ class Searcher:
         modelFilePath: Text, 
         queriesFilePath: Text,
         resultsFilePath: Text,
-        useStemmer: bool = False
+        useStemmer: bool = False,
+        batch: bool = False,
+        numWorkers: int = 1,
+        limit: int = None,
+        simThreshold: float = None,
+        cacheFilePath: Text = None,
+        cacheSize: int = 1024
     ) -> None:
         self.modelFilePath = modelFilePath
         self.queriesFilePath = queriesFilePath
         self.resultsFilePath = resultsFilePath
         self.useStemmer = useStemmer
+        self.batch = batch
+        self.numWorkers = numWorkers
+        self.limit = limit
+        self.simThreshold = simThreshold
+        self.cacheFilePath = cacheFilePath
+        self.cacheSize = cacheSize
         self.model = None
+        self.cache = None
         self.queries = None
         self.logger = log.initLogger("SEARCHER")
 
     def loadModel(self):
-        model = pickle.load(open(self.modelFilePath, "rb"))
+        # The shards of a sharded model are scored in parallel, one per worker
+        model = loadModel(self.modelFilePath, numProcesses = self.numWorkers)
         return model
+
+    def loadCache(self):
+        cache = QueryResultCache(self.model.contentHash, cacheFilePath = self.cacheFilePath, maxSize = self.cacheSize)
+        return cache
     
     def loadQueries(self):
         queries = pd.read_csv(self.queriesFilePath, sep = ";")
         return queries  
     
-    def searchFromQuery(self, query: Text, limit = None, simThreshold = None):
-        if (limit is not None) and simThreshold is not None:
-            raise ValueError("limit and simThreshold can not be set at the same time.")
+    def getQueryTerms(self, query: Text) -> List:
         queryTerms = vectorizeText(query, self.useStemmer)
         queryTerms = pd.Series(queryTerms).apply(str.upper).unique()
         queryTerms = self.model.filterQueryTerms(queryTerms)
-        similarities = []
-        for queryTerm in queryTerms:
-            documentIDs = self.model.filterDocumentsByQueryTerms(queryTerms)
-            for documentID in documentIDs:
-                weightQueryTermInDocumentID = self.model.getWeight(documentID, queryTerm, normalized = True)
-                similarities.append([documentID, weightQueryTermInDocumentID])
-        similarities = pd.DataFrame(data = similarities, columns = ["documentID", "similarity"])
-        similarities = similarities.groupby("documentID").sum().reset_index()
-        similarities = similarities.sort_values("similarity", ascending = False).reset_index(drop = True)
-        similarities["rank"] = similarities.index + 1
-        if limit:
-            similarities = similarities.iloc[:limit]
-        if simThreshold:
-            similarities = similarities[similarities.similarity >= simThreshold]
+        return queryTerms
+
+    def searchFromQuery(self, query: Text, limit = None, simThreshold = None):
+        # The scorer already returns the ranked documents cut by limit and
+        # simThreshold, so only the rows written to the results are built
+        queryTerms = self.getQueryTerms(query)
+        limit = limit if limit else None
+        if self.cache is None:
+            documentIDs, scores = self.model.scoreQueryTerms(queryTerms, limit = limit, threshold = simThreshold)
+        else:
+            key = self.cache.getKey(queryTerms, limit, simThreshold)
+            cached = self.cache.get(key)
+            if cached is None:
+                cached = self.model.scoreQueryTerms(queryTerms, limit = limit, threshold = simThreshold)
+                self.cache.put(key, cached)
+            documentIDs, scores = cached
+        similarities = pd.DataFrame(data = {"documentID": documentIDs, "similarity": scores, "rank": np.arange(1, len(scores) + 1)})
         return similarities
 
-    def runQueries(self, limit = None, simThreshold = None):
+    def searchQueries(self, queries: pd.DataFrame, limit = None, simThreshold = None, showProgress = False):
         results = []
-        for i in tqdm(self.queries.index, desc = "Running queries..."):
-            row = self.queries.loc[i]
-            query = row.queryText
-            number = row.queryNumber
+        for number, query in tqdm(
+            zip(queries.queryNumber, queries.queryText), 
+            total = queries.shape[0], 
+            desc = "Running queries...", 
+            disable = not showProgress
+        ):
             queryResults = self.searchFromQuery(query, limit = limit, simThreshold = simThreshold)
             queryResults["queryNumber"] = number
             queryResults = queryResults[["queryNumber", "rank", "documentID", "similarity"]]
             results.append(queryResults)
+        if len(results) == 0:
+            return pd.DataFrame(columns = ["queryNumber", "rank", "documentID", "similarity"])
         results = pd.concat(results)
         return results
 
+    def runQueries(self, limit = None, simThreshold = None):
+        # A sharded model already scatters each query to its shard workers
+        if self.numWorkers <= 1 or isinstance(self.model, ShardedTermDocumentMatrix):
+            return self.searchQueries(self.queries, limit = limit, simThreshold = simThreshold, showProgress = True)
+
+        # Contiguous chunks of queries are searched by a pool of processes that
+        # map the same model file, and concatenated back in the original order.
+        # There are never more chunks than queries, so no chunk is empty
+        numChunks = max(1, min(self.numWorkers * 4, self.queries.shape[0]))
+        chunks = [self.queries.iloc[positions] for positions in np.array_split(np.arange(self.queries.shape[0]), numChunks)]
+        with ProcessPoolExecutor(
+            max_workers = self.numWorkers, 
+            initializer = initSearchWorker, 
+            initargs = (self.modelFilePath, self.useStemmer, self.cacheFilePath, self.cacheSize)
+        ) as executor:
+            chunkResults = list(tqdm(
+                executor.map(searchWorkerQueries, chunks, repeat(limit), repeat(simThreshold)), 
+                total = len(chunks), 
+                desc = "Running queries..."
+            ))
+        results = pd.concat([results for results, hits, misses in chunkResults])
+        # Each worker has its own in-memory cache tier and reports how many
+        # lookups of its chunk were hits and misses
+        self.cache.hits += sum(hits for results, hits, misses in chunkResults)
+        self.cache.misses += sum(misses for results, hits, misses in chunkResults)
+        return results
+
+    def runQueriesBatch(self, limit = None, simThreshold = None):
+        queryTermsList = [self.getQueryTerms(query) for query in self.queries.queryText]
+        queries, ranks, documentIDs, similarities = self.model.scoreQueryTermsBatch(
+            queryTermsList, limit = limit if limit else None, threshold = simThreshold
+        )
+        results = pd.DataFrame({
+            "queryNumber": self.queries.queryNumber.to_numpy()[queries],
+            "rank": ranks,
+            "documentID": documentIDs,
+            "similarity": similarities
+        })
+        return results
+
     def _run(self):
         self.model = log.executeFunction(
             logger = self.logger, 
@@ -81,6 +147,14 @@ class Searcher:
             func = self.loadModel
         )
 
+        self.cache = log.executeFunction(
+            logger = self.logger, 
+            onStartMessage = "Loading query result cache",
+            onFinishMessage = "Query result cache was loaded with success",
+            onErrorMessage = "Error while loading query result cache",
+            func = self.loadCache
+        )
+
         self.queries = log.executeFunction(
             logger = self.logger, 
             onStartMessage = "Loading queries",
@@ -95,12 +169,44 @@ class Searcher:
             onStartMessage = "Running queries",
             onFinishMessage = "All queries were executed with success",
             onErrorMessage = "Error while running queries",
-            func = self.runQueries,
+            func = self.runQueriesBatch if self.batch else self.runQueries,
+            limit = self.limit,
+            simThreshold = self.simThreshold
         )
+        if not self.batch:
+            self.logger.info(f"Query result cache: {self.cache.hits} hits, {self.cache.misses} misses")
+        self.cache.close()
+        if isinstance(self.model, ShardedTermDocumentMatrix):
+            self.model.close()
 
         self.logger.info("Storing results")
         results.to_csv(self.resultsFilePath, index = False, sep = ";")
         self.logger.info("Results were stored with success")
 
     def run(self):
-        log.executeModule(self.logger, self._run)
\ No newline at end of file
+        log.executeModule(self.logger, self._run)
+
+searchWorker = None
+
+def initSearchWorker(modelFilePath: Text, useStemmer: bool, cacheFilePath: Text = None, cacheSize: int = 1024):
+    # Runs once in each worker process: the model is memory-mapped, so every
+    # worker shares the same page-cached arrays instead of its own copy
+    global searchWorker
+    searchWorker = Searcher(
+        modelFilePath = modelFilePath, 
+        queriesFilePath = None, 
+        resultsFilePath = None, 
+        useStemmer = useStemmer,
+        cacheFilePath = cacheFilePath,
+        cacheSize = cacheSize
+    )
+    searchWorker.model = searchWorker.loadModel()
+    searchWorker.cache = searchWorker.loadCache()
+
+def searchWorkerQueries(queries: pd.DataFrame, limit = None, simThreshold = None):
+    hits, misses = searchWorker.cache.hits, searchWorker.cache.misses
+    results = searchWorker.searchQueries(queries, limit = limit, simThreshold = simThreshold)
+    # The results of the chunk are written to the cache file at once, since
+    # worker processes are never closed explicitly
+    searchWorker.cache.flush()
+    return results, searchWorker.cache.hits - hits, searchWorker.cache.misses - misses
@@ -0,0 +1,5 @@
+import os
+import sys
+
+PROJECT_DIR = os.path.normpath(f"{os.path.dirname(os.path.abspath(__file__))}/..")
+sys.path.append(PROJECT_DIR)
@@ -0,0 +1,37 @@
+import os
+import pandas as pd
+from src.indexer import IndexSegments
+
+def addDocumentFile(segments: IndexSegments, documentFilePath, settings):
+    with open(documentFilePath, "w") as f:
+        f.write(os.path.basename(documentFilePath))
+    documentFilePathList = [path for path in sorted(os.listdir(os.path.dirname(documentFilePath))) if path.endswith(".xml")]
+    documentFilePathList = [os.path.join(os.path.dirname(documentFilePath), path) for path in documentFilePathList]
+    newDocumentFilePathList = segments.getNewDocumentFiles(documentFilePathList, settings)
+    invertedList = pd.DataFrame({
+        "term": ["CYSTIC", "FIBROSIS"],
+        "documentID": [os.path.basename(path) for path in newDocumentFilePathList][:1]*2,
+        "termCount": [1, 2]
+    })
+    segments.addSegment(invertedList, newDocumentFilePathList)
+
+def getSegmentFileNames(segmentsDirPath):
+    return sorted(name for name in os.listdir(segmentsDirPath) if name.endswith(".npz"))
+
+def test_changed_settings_delete_old_segments(tmp_path):
+    documentsDirPath, segmentsDirPath = tmp_path/"documents", tmp_path/"segments"
+    documentsDirPath.mkdir()
+    segments = IndexSegments(str(segmentsDirPath))
+    stemmerSettings = {"useStemmer": True, "filterTerms": False}
+    for name in ["cf74.xml", "cf75.xml", "cf76.xml"]:
+        addDocumentFile(segments, str(documentsDirPath/name), stemmerSettings)
+    assert getSegmentFileNames(segmentsDirPath) == ["segment-000000.npz", "segment-000001.npz", "segment-000002.npz"]
+
+    segments = IndexSegments(str(segmentsDirPath))
+    newDocumentFilePathList = segments.getNewDocumentFiles(
+        [str(documentsDirPath/name) for name in ["cf74.xml", "cf75.xml", "cf76.xml"]],
+        {"useStemmer": False, "filterTerms": False}
+    )
+    assert len(newDocumentFilePathList) == 3
+    assert segments.manifest["segments"] == []
+    assert getSegmentFileNames(segmentsDirPath) == []
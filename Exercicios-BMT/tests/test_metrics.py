@@ -0,0 +1,23 @@
+import numpy as np
+import pandas as pd
+from utils import metrics
+
+def getRuns():
+    # Query 1 retrieves B and then A, and A is judged twice with different grades
+    retrieved = pd.DataFrame({"queryNumber": [1, 1], "documentID": ["B", "A"], "score": [0.9, 0.8]})
+    relevant = pd.DataFrame({"queryNumber": [1, 1, 1], "documentID": ["A", "C", "A"], "relevance": [1, 1, 2]})
+    return retrieved, relevant
+
+def test_duplicated_judgment_uses_last_grade():
+    retrieved, relevant = getRuns()
+    judgedRankings = metrics.getJudgedRankings(retrieved, relevant)
+    np.testing.assert_array_equal(judgedRankings["relevance"], [[0, 2]])
+    np.testing.assert_array_equal(judgedRankings["idealRelevance"], [[2, 1]])
+    np.testing.assert_array_equal(judgedRankings["numRelevant"], [2])
+
+def test_duplicated_judgment_discounted_cumulative_gain():
+    retrieved, relevant = getRuns()
+    score = metrics.discountedCumulativeGain(retrieved, relevant, limit = 10, returnPlot = False)
+    np.testing.assert_allclose(score, [0, 2])
+    recall = metrics.getMetricScore(retrieved, relevant, scoreFuncs = [metrics._recallScore])
+    np.testing.assert_allclose(recall._recallScore, [0.5])
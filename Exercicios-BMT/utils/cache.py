@@ -0,0 +1,87 @@
+import json
+import pickle
+import sqlite3
+from collections import OrderedDict
+from typing import Text
+
+class QueryResultCache:
+    # Two-tier cache of query results: a bounded in-memory LRU and, when a
+    # file path is given, a sqlite table that survives restarts. Every key
+    # includes the model content hash, so results of other models are never
+    # returned, and the on-disk entries of other models are dropped on open.
+    # New entries are buffered and written in a single transaction once
+    # flushSize of them are pending, on flush or on close, so that processes
+    # sharing the file rarely wait on its lock
+    def __init__(self, modelHash: Text, cacheFilePath: Text = None, maxSize: int = 1024, flushSize: int = 256):
+        self.modelHash = modelHash
+        self.cacheFilePath = cacheFilePath
+        self.maxSize = maxSize
+        self.flushSize = flushSize
+        self.memory = OrderedDict()
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+        self.connection = None
+        if cacheFilePath is not None:
+            self.connection = sqlite3.connect(cacheFilePath, timeout = 60)
+            with self.connection:
+                self.connection.execute(
+                    "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, modelHash TEXT, value BLOB)"
+                )
+                self.connection.execute("DELETE FROM results WHERE modelHash != ?", (modelHash,))
+
+    def getKey(self, queryTerms, limit = None, threshold = None) -> Text:
+        return json.dumps([self.modelHash, sorted(queryTerms), limit, threshold])
+
+    def get(self, key: Text):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return self.memory[key]
+
+        if key in self.pending:
+            self.putInMemory(key, self.pending[key])
+            self.hits += 1
+            return self.pending[key]
+
+        if self.connection is not None:
+            row = self.connection.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                value = pickle.loads(row[0])
+                self.putInMemory(key, value)
+                self.hits += 1
+                return value
+
+        self.misses += 1
+        return None
+
+    def put(self, key: Text, value):
+        self.putInMemory(key, value)
+        if self.connection is not None:
+            self.pending[key] = value
+            if len(self.pending) >= self.flushSize:
+                self.flush()
+
+    def flush(self):
+        if self.connection is not None and len(self.pending) > 0:
+            with self.connection:
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO results (key, modelHash, value) VALUES (?, ?, ?)",
+                    [
+                        (key, self.modelHash, pickle.dumps(value, protocol = pickle.HIGHEST_PROTOCOL))
+                        for key, value in self.pending.items()
+                    ]
+                )
+        self.pending = {}
+
+    def putInMemory(self, key: Text, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.maxSize:
+            self.memory.popitem(last = False)
+
+    def close(self):
+        self.flush()
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
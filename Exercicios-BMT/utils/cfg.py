@@ -42,15 +42,17 @@ class QueryProcessorConfig(ConfigBase):
         self.requiredInstructions = ["LEIA", "CONSULTAS", "ESPERADOS"]
 
 class InvertedListGeneratorConfig(ConfigBase):
+    # ESCREVA is optional: without it the inverted list is only kept in memory.
+    # SEGMENTOS is optional: with it the index is updated incrementally
     def __init__(self, configPath: Text):
         super().__init__(configPath)
-        self.requiredInstructions = ["STEMMER", "LEIA", "ESCREVA"]
+        self.requiredInstructions = ["STEMMER", "LEIA"]
 
     def checkRequiredInstructions(self) -> bool:
         if self.cfg is not None:
             instructions = set(self.cfg.keys())
             if len(set(self.requiredInstructions) - instructions) == 0:
-                if len(self.cfg["ESCREVA"])  == 1:
+                if len(self.cfg.get("ESCREVA", [])) <= 1:
                     return True
         return False
 
@@ -69,7 +71,9 @@ class InvertedListGeneratorConfig(ConfigBase):
             if not hasAllRequiredInstructions:            
                 raise Exception(f"Error while parsing config file. The following parameters are required: {', '.join(self.requiredInstructions)}")
 
-            self.cfg["ESCREVA"] = self.cfg["ESCREVA"][0]
+            self.cfg["ESCREVA"] = self.cfg["ESCREVA"][0] if "ESCREVA" in self.cfg else None
+            self.cfg["PROCESSOS"] = int(self.cfg["PROCESSOS"][0]) if "PROCESSOS" in self.cfg else 1
+            self.cfg["SEGMENTOS"] = self.cfg["SEGMENTOS"][0] if "SEGMENTOS" in self.cfg else None
 
             return self.cfg
 
@@ -77,9 +81,10 @@ class InvertedListGeneratorConfig(ConfigBase):
             raise e
         
 class IndexerConfig(ConfigBase):
+    # LEIA is optional: without it the indexer receives the inverted list in memory
     def __init__(self, configPath: Text):
         super().__init__(configPath)
-        self.requiredInstructions = ["LEIA", "ESCREVA"]
+        self.requiredInstructions = ["ESCREVA"]
 
 class SearcherConfig(ConfigBase):
     def __init__(self, configPath: Text):
@@ -117,4 +122,28 @@ class EvaluatorConfig(ConfigBase):
             return self.cfg
 
         except Exception as e: 
-            raise e
\ No newline at end of file
+            raise e
+
+class BenchmarkConfig(InvertedListGeneratorConfig):
+    # Same layout as GLI.CFG (STEMMER or NOSTEMMER in the first line and the
+    # document files in LEIA), plus the queries file in CONSULTAS, the
+    # working directory in DIRETORIO and the JSON results file in ESCREVA.
+    # ESCALAS (e.g. 1,10,100,1000), LIMITE (10 by default), PROCESSOS,
+    # FRAGMENTOS and COMPRESSAO are optional
+    def __init__(self, configPath: Text):
+        super().__init__(configPath)
+        self.requiredInstructions = ["STEMMER", "LEIA", "CONSULTAS", "DIRETORIO", "ESCREVA"]
+
+    def loadConfig(self) -> None:
+        try:
+            super().loadConfig()
+            for instruction in ["CONSULTAS", "DIRETORIO", "FRAGMENTOS", "COMPRESSAO"]:
+                if instruction in self.cfg:
+                    self.cfg[instruction] = self.cfg[instruction][0]
+            self.cfg["ESCALAS"] = [int(scale) for scale in self.cfg["ESCALAS"][0].split(",")] if "ESCALAS" in self.cfg else [1, 10, 100, 1000]
+            self.cfg["LIMITE"] = int(self.cfg["LIMITE"][0]) if "LIMITE" in self.cfg else 10
+
+            return self.cfg
+
+        except Exception as e: 
+            raise e
@@ -0,0 +1,114 @@
+import numpy as np
+
+# Compressed postings layout: the postings of each term are split into blocks
+# of at most blockSize postings, and each block holds the varint encoded
+# document gaps of its postings followed by their varint encoded term counts.
+# Gaps are taken from the previous posting of the same term, so the first
+# gap of a term is its first document ordinal. blockOffsets has the byte
+# offset of each block, termBlockOffsets the first block of each term and
+# blockLastOrdinals the last document ordinal of each block, which lets any
+# block be decoded (or skipped) without decoding the ones before it
+POSTING_BLOCK_SIZE = 128
+
+def encodeVarints(values: np.ndarray):
+    # LEB128: 7 bits per byte, least significant group first, with the high
+    # bit set on every byte but the last one of a value
+    values = np.asarray(values, dtype = np.uint64)
+    numBytes = np.ones(len(values), dtype = np.int64)
+    for shift in range(7, 64, 7):
+        numBytes += values >= np.uint64(1 << shift)
+    byteOffsets = np.zeros(len(values) + 1, dtype = np.int64)
+    byteOffsets[1:] = np.cumsum(numBytes)
+
+    data = np.zeros(byteOffsets[-1], dtype = np.uint8)
+    for j in range(int(numBytes.max(initial = 0))):
+        mask = numBytes > j
+        groups = (values[mask] >> np.uint64(7*j)) & np.uint64(0x7F)
+        continuation = np.where(numBytes[mask] > j + 1, 0x80, 0).astype(np.uint64)
+        data[byteOffsets[:-1][mask] + j] = groups | continuation
+    return data, byteOffsets
+
+def decodeVarints(data: np.ndarray) -> np.ndarray:
+    if len(data) == 0:
+        return np.zeros(0, dtype = np.uint64)
+    isLast = data < 0x80
+    valueStarts = np.concatenate(([0], np.flatnonzero(isLast)[:-1] + 1))
+    valueIndexes = np.cumsum(isLast) - isLast
+    shifts = (np.arange(len(data)) - valueStarts[valueIndexes]) * 7
+    groups = (data & 0x7F).astype(np.uint64) << shifts.astype(np.uint64)
+    return np.add.reduceat(groups, valueStarts)
+
+def getValuePositions(blockStarts: np.ndarray, blockEnds: np.ndarray):
+    # Positions of the gap and of the term count of every posting of a run of
+    # consecutive blocks, in the values decoded from those blocks
+    blockLengths = blockEnds - blockStarts
+    if len(blockLengths) == 0:
+        return np.zeros(0, dtype = np.int64), np.zeros(0, dtype = np.int64)
+    postingIndexes = np.arange(blockStarts[0], blockEnds[-1])
+    gapPositions = np.repeat(blockStarts, blockLengths) + postingIndexes - 2*blockStarts[0]
+    countPositions = gapPositions + np.repeat(blockLengths, blockLengths)
+    return gapPositions, countPositions
+
+def getTermBlocks(termOffsets: np.ndarray, termOrdinal, blockSize: int):
+    # First and last posting of each block of a term
+    start, end = int(termOffsets[termOrdinal]), int(termOffsets[termOrdinal + 1])
+    blockStarts = np.arange(start, end, blockSize)
+    blockEnds = np.minimum(blockStarts + blockSize, end)
+    return blockStarts, blockEnds
+
+def getBlockLayout(termOffsets: np.ndarray, blockSize: int):
+    # First block of each term, and first and last posting of every block
+    termLengths = np.diff(termOffsets)
+    termBlockCounts = -(-termLengths // blockSize)
+    termBlockOffsets = np.zeros(len(termLengths) + 1, dtype = np.int64)
+    termBlockOffsets[1:] = np.cumsum(termBlockCounts)
+    blockTerms = np.repeat(np.arange(len(termLengths)), termBlockCounts)
+    blockStarts = termOffsets[blockTerms] + (np.arange(termBlockOffsets[-1]) - termBlockOffsets[blockTerms]) * blockSize
+    blockEnds = np.minimum(blockStarts + blockSize, termOffsets[blockTerms + 1])
+    return termBlockOffsets, blockStarts, blockEnds
+
+def encodePostings(termOffsets: np.ndarray, documentOrdinals: np.ndarray, termCounts: np.ndarray, blockSize: int = POSTING_BLOCK_SIZE):
+    termBlockOffsets, blockStarts, blockEnds = getBlockLayout(termOffsets, blockSize)
+    termLengths = np.diff(termOffsets)
+    gaps = np.diff(documentOrdinals.astype(np.int64), prepend = 0)
+    firstPostings = termOffsets[:-1][termLengths > 0]
+    gaps[firstPostings] = documentOrdinals[firstPostings]
+
+    gapPositions, countPositions = getValuePositions(blockStarts, blockEnds)
+    values = np.zeros(2*len(documentOrdinals), dtype = np.uint64)
+    values[gapPositions] = gaps
+    values[countPositions] = termCounts
+
+    data, byteOffsets = encodeVarints(values)
+    return {
+        "postingBlocks": data,
+        "blockOffsets": np.append(byteOffsets[2*blockStarts], len(data)),
+        "termBlockOffsets": termBlockOffsets,
+        "blockLastOrdinals": documentOrdinals[blockEnds - 1].astype(np.int32)
+    }
+
+def decodePostings(data: np.ndarray, blockOffsets: np.ndarray, blockLastOrdinals: np.ndarray, firstBlock: int, blockStarts: np.ndarray, blockEnds: np.ndarray, isTermStart: bool):
+    # Document ordinals and term counts of a run of consecutive blocks of a
+    # term, starting at firstBlock. The gaps restart from the last ordinal of
+    # the previous block, unless the run starts at the first block of the term
+    lastBlock = firstBlock + len(blockStarts)
+    values = decodeVarints(data[blockOffsets[firstBlock]:blockOffsets[lastBlock]])
+    gapPositions, countPositions = getValuePositions(blockStarts, blockEnds)
+    base = 0 if isTermStart else int(blockLastOrdinals[firstBlock - 1])
+    documentOrdinals = (np.cumsum(values[gapPositions].astype(np.int64)) + base).astype(np.int32)
+    termCounts = values[countPositions].astype(np.int32)
+    return documentOrdinals, termCounts
+
+def decodeAllPostings(termOffsets: np.ndarray, data: np.ndarray, blockSize: int):
+    # Decodes every block at once, restarting the running sum of the gaps at
+    # the first posting of each term
+    _, blockStarts, blockEnds = getBlockLayout(termOffsets, blockSize)
+    values = decodeVarints(data)
+    gapPositions, countPositions = getValuePositions(blockStarts, blockEnds)
+    runningSum = np.cumsum(values[gapPositions].astype(np.int64))
+    termLengths = np.diff(termOffsets)
+    termStarts = termOffsets[:-1][termLengths > 0]
+    restart = np.repeat(runningSum[termStarts] - values[gapPositions][termStarts].astype(np.int64), termLengths[termLengths > 0])
+    documentOrdinals = (runningSum - restart).astype(np.int32)
+    termCounts = values[countPositions].astype(np.int32)
+    return documentOrdinals, termCounts
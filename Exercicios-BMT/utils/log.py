@@ -40,7 +40,8 @@ def executeFunction(
 def executeModule(logger: logging.Logger, moduleFunction, **kwargs):
     logger.info("Starting module")
     startTime = time()
-    moduleFunction(**kwargs)
+    results = moduleFunction(**kwargs)
     finishTime = time()
     elapsedTime = finishTime - startTime
-    logger.info(f"Module has been executed with success (Elapsed Time: {elapsedTime:.2f}s)")
\ No newline at end of file
+    logger.info(f"Module has been executed with success (Elapsed Time: {elapsedTime:.2f}s)")
+    return results
\ No newline at end of file
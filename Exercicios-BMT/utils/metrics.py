@@ -1,9 +1,14 @@
-import matplotlib.pyplot as plt
-import seaborn as sns
 import pandas as pd
 import numpy as np
 from typing import Union, List
 
+def importPlotting():
+    # The plotting stack is only imported once a figure is requested, so
+    # evaluations without plots never load matplotlib and seaborn
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    return plt, sns
+
 def filterRetrievedDocs(retrievedDocs: Union[pd.DataFrame, List], limit = None, threshold = None):
     if limit is not None and threshold is not None:
         raise ValueError("Either limit or threshold should be None.")
@@ -18,12 +23,7 @@ def filterRetrievedDocs(retrievedDocs: Union[pd.DataFrame, List], limit = None,
             if type(retrievedDocs) is list:
                 retrievedDocs = retrievedDocs[:limit]
             else:
-                tmpDF = retrievedDocs.copy(deep = True)
-                tmpDF["keep"] = False
-                tmpDF["keep"] = tmpDF[["queryNumber", "keep"]].groupby("queryNumber").transform(
-                    lambda group: [i < limit for i in range(group.shape[0])]
-                )
-                retrievedDocs = tmpDF[tmpDF["keep"]].drop("keep", axis = 1)
+                retrievedDocs = retrievedDocs[retrievedDocs.groupby("queryNumber").cumcount() < limit]
     
     if threshold is not None:
         if type(retrievedDocs) is list:
@@ -79,18 +79,14 @@ def _rPrecisionScore(queryDocsDF):
     return rPrecision
 
 def _meanAveragePrecisionScore(queryDocsDF):
+    # Average of the precision at the rank of each relevant document, where
+    # relevant documents that were not retrieved count as zero
     retrieved = queryDocsDF.retrievedDoc
-    retrievedSet = set(retrieved)
-    relevant = queryDocsDF.relevantDoc
-    relevantRanks = [retrieved.index(doc) + 1 if doc in retrievedSet else 0 for doc in relevant]
-    precisionAtK = []
-    for k in relevantRanks:
-        df = queryDocsDF.copy(deep = True)
-        df["retrievedDoc"] = df["retrievedDoc"][:k]
-        df["relevantDoc"] = df["relevantDoc"][:k]
-        precisionAtK.append(_precisionScore(df))
-    meanAveragePrecision = np.nanmean(precisionAtK)
-    return meanAveragePrecision
+    relevantSet = set(queryDocsDF.relevantDoc)
+    relevantRanks = [rank for rank, documentID in enumerate(retrieved, start = 1) if documentID in relevantSet]
+    precisionAtK = [(i + 1)/k for i, k in enumerate(relevantRanks)]
+    averagePrecision = sum(precisionAtK)/len(relevantSet)
+    return averagePrecision
 
 def _meanReciprocalRankScore(queryDocsDF):
     retrieved = queryDocsDF.retrievedDoc
@@ -114,6 +110,174 @@ def _discountedCumulativeGainScore(queryDocsDF):
         discountedCumulativeGain.append(discountedCumulativeGain[-1] + relevant.get(documentID, 0)*discountFactor)
     return discountedCumulativeGain
 
+# Metrics computed by the vectorized engine (see scoreJudgedRankings)
+SCALAR_METRICS = [
+    "_precisionScore", "_recallScore", "_f1Score", "_rPrecisionScore",
+    "_meanAveragePrecisionScore", "_meanReciprocalRankScore", "_normalizedDiscountedCumulativeGainScore"
+]
+
+def getJudgedRankings(retrievedDocs: pd.DataFrame, relevantDocs: pd.DataFrame, limit = None, threshold = None):
+    # Encodes the ranked lists of a run as a queries x ranks matrix with the
+    # relevance of each retrieved document (0 when it is not relevant), for
+    # the queries that have both retrieved and relevant documents, along
+    # with the ideal ranking of each query: its judged documents sorted by
+    # decreasing relevance. When a document is judged more than once for the
+    # same query, its last judgment is the one used, as in the row-wise
+    # metrics this engine replaced
+    if limit is not None and threshold is not None:
+        raise ValueError("Either limit or threshold should be None.")
+    if limit is not None and limit <= 0:
+        raise ValueError("Limit should be greater than zero.")
+
+    allQueryNumbers = retrievedDocs.queryNumber.drop_duplicates().to_numpy()
+    relevantDocs = relevantDocs.drop_duplicates(["queryNumber", "documentID"], keep = "last")
+    queryNumbers = allQueryNumbers[np.isin(allQueryNumbers, relevantDocs.queryNumber.to_numpy())]
+
+    if threshold is not None:
+        retrievedDocs = retrievedDocs[retrievedDocs["score"] >= threshold]
+    ranks = retrievedDocs.groupby("queryNumber").cumcount().to_numpy()
+    if limit is not None:
+        retrievedDocs, ranks = retrievedDocs[ranks < limit], ranks[ranks < limit]
+
+    relevances = pd.merge(
+        retrievedDocs[["queryNumber", "documentID"]], relevantDocs[["queryNumber", "documentID", "relevance"]],
+        on = ["queryNumber", "documentID"], how = "left"
+    ).relevance.to_numpy(dtype = np.float64)
+    queries = pd.Index(queryNumbers).get_indexer(retrievedDocs.queryNumber.to_numpy())
+    judged = queries >= 0
+    queries, ranks, relevances = queries[judged], ranks[judged], relevances[judged]
+
+    numRanks = int(ranks.max()) + 1 if len(ranks) > 0 else 0
+    relevance = np.zeros((len(queryNumbers), numRanks), dtype = np.float64)
+    isRelevant = np.zeros((len(queryNumbers), numRanks), dtype = bool)
+    relevance[queries, ranks] = np.nan_to_num(relevances)
+    isRelevant[queries, ranks] = ~np.isnan(relevances)
+
+    relevantCounts = relevantDocs.groupby("queryNumber").size()
+    idealDocs = relevantDocs[relevantDocs.queryNumber.isin(queryNumbers)].sort_values(
+        ["queryNumber", "relevance"], ascending = [True, False], kind = "stable"
+    )
+    idealRanks = idealDocs.groupby("queryNumber").cumcount().to_numpy()
+    idealQueries = pd.Index(queryNumbers).get_indexer(idealDocs.queryNumber.to_numpy())
+    numIdealRanks = int(idealRanks.max()) + 1 if len(idealRanks) > 0 else 0
+    idealRelevance = np.zeros((len(queryNumbers), numIdealRanks), dtype = np.float64)
+    idealRelevance[idealQueries, idealRanks] = idealDocs.relevance.to_numpy(dtype = np.float64)
+
+    return truncateJudgedRankings({
+        "queryNumber": queryNumbers,
+        "relevance": relevance,
+        "isRelevant": isRelevant,
+        "numRetrieved": np.bincount(queries, minlength = len(queryNumbers)),
+        "numRelevant": relevantCounts.reindex(queryNumbers).to_numpy(),
+        "idealRelevance": idealRelevance,
+        "limit": None
+    }, limit)
+
+rankDiscounts = np.zeros(0)
+
+def getRankDiscounts(numRanks: int) -> np.ndarray:
+    # DCG discount of each rank: the first two ranks are not discounted. The
+    # discounts come from a table that at least doubles whenever it is short
+    global rankDiscounts
+    if len(rankDiscounts) < numRanks:
+        tableSize = max(numRanks, 2*len(rankDiscounts))
+        rankDiscounts = 1/np.log2(np.maximum(np.arange(1, tableSize + 1), 2))
+    return rankDiscounts[:numRanks]
+
+def truncateJudgedRankings(judgedRankings, limit = None):
+    # Judged rankings of the same run cut at a smaller limit, as views
+    if limit is None:
+        return judgedRankings
+    return {
+        **judgedRankings,
+        "relevance": judgedRankings["relevance"][:, :limit],
+        "isRelevant": judgedRankings["isRelevant"][:, :limit],
+        "numRetrieved": np.minimum(judgedRankings["numRetrieved"], limit),
+        "idealRelevance": judgedRankings["idealRelevance"][:, :limit],
+        "limit": limit
+    }
+
+def getCumulativeGains(relevance: np.ndarray) -> np.ndarray:
+    return np.cumsum(relevance * getRankDiscounts(relevance.shape[1]), axis = 1)
+
+def getGainsAtRanks(cumulativeGains: np.ndarray, ks) -> np.ndarray:
+    # Cumulative gains at each rank k, which stay flat past the last column
+    numQueries, numRanks = cumulativeGains.shape
+    if numRanks == 0:
+        return np.zeros((numQueries, len(ks)))
+    return cumulativeGains[:, np.minimum(ks, numRanks) - 1]
+
+def getDiscountedCumulativeGains(judgedRankings) -> np.ndarray:
+    # Queries x ranks matrix of DCG, which stays flat after the last
+    # retrieved document of each query
+    return getCumulativeGains(judgedRankings["relevance"])
+
+def getAverageDiscountedCumulativeGains(judgedRankings) -> np.ndarray:
+    # Average DCG of the queries at each rank, where the DCG of a query is 0
+    # past its last retrieved document (and not its final value)
+    discountedCumulativeGains = getDiscountedCumulativeGains(judgedRankings)
+    isRetrieved = np.arange(discountedCumulativeGains.shape[1]) < judgedRankings["numRetrieved"][:, None]
+    return np.where(isRetrieved, discountedCumulativeGains, 0).mean(axis = 0)
+
+def getNormalizedDiscountedCumulativeGains(judgedRankings, ks) -> np.ndarray:
+    # Queries x ks matrix of NDCG@k: the DCG of the first k retrieved
+    # documents over the DCG of the first k documents of the ideal ranking,
+    # which holds every judged document of the query and not only the
+    # retrieved ones (0 when the ideal DCG is 0)
+    ks = np.asarray(ks, dtype = np.int64)
+    gains = getGainsAtRanks(getDiscountedCumulativeGains(judgedRankings), ks)
+    idealGains = getGainsAtRanks(getCumulativeGains(judgedRankings["idealRelevance"]), ks)
+    return np.divide(gains, idealGains, out = np.zeros(gains.shape), where = idealGains > 0)
+
+def scoreJudgedRankings(judgedRankings) -> pd.DataFrame:
+    # Every per query metric at once, from the cumulative number of relevant
+    # documents at each rank
+    isRelevant = judgedRankings["isRelevant"]
+    numRetrieved = judgedRankings["numRetrieved"]
+    numRelevant = judgedRankings["numRelevant"]
+    numQueries, numRanks = isRelevant.shape
+    relevantAtRank = np.cumsum(isRelevant, axis = 1)
+    hits = relevantAtRank[:, -1] if numRanks > 0 else np.zeros(numQueries, dtype = np.int64)
+
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        precision = np.where(numRetrieved > 0, hits/numRetrieved, np.nan)
+        recall = hits/numRelevant
+        f1 = np.where(precision + recall > 0, 2*precision*recall/(precision + recall), np.nan)
+
+    rPrecisionRanks = np.minimum(numRelevant, numRanks) - 1
+    rPrecision = np.where(
+        rPrecisionRanks >= 0,
+        relevantAtRank[np.arange(numQueries), np.maximum(rPrecisionRanks, 0)] if numRanks > 0 else 0,
+        0
+    )/numRelevant
+
+    precisionAtRank = relevantAtRank/np.arange(1, numRanks + 1)
+    averagePrecision = (precisionAtRank*isRelevant).sum(axis = 1)/numRelevant
+    firstRelevantRank = np.argmax(isRelevant, axis = 1) + 1 if numRanks > 0 else np.ones(numQueries)
+    reciprocalRank = np.where(hits > 0, 1/firstRelevantRank, 0)
+
+    # NDCG at the limit of the rankings, or of the whole rankings without one
+    limit = judgedRankings["limit"]
+    limit = max(numRanks, judgedRankings["idealRelevance"].shape[1], 1) if limit is None else limit
+    normalizedGains = getNormalizedDiscountedCumulativeGains(judgedRankings, [limit])[:, 0]
+
+    return pd.DataFrame({
+        "queryNumber": judgedRankings["queryNumber"],
+        "_precisionScore": precision,
+        "_recallScore": recall,
+        "_f1Score": f1,
+        "_rPrecisionScore": rPrecision,
+        "_meanAveragePrecisionScore": averagePrecision,
+        "_meanReciprocalRankScore": reciprocalRank,
+        "_normalizedDiscountedCumulativeGainScore": normalizedGains
+    })
+
+def getDiscountedCumulativeGainLists(judgedRankings) -> List:
+    # DCG of each query at each of its retrieved documents, as the lists the
+    # row-wise _discountedCumulativeGainScore returned
+    discountedCumulativeGains = getDiscountedCumulativeGains(judgedRankings)
+    return [list(gains[:length]) for gains, length in zip(discountedCumulativeGains, judgedRankings["numRetrieved"])]
+
 def getMetricScore(
         retrievedDocs: pd.DataFrame, 
         relevantDocs: pd.DataFrame, 
@@ -123,76 +287,84 @@ def getMetricScore(
         threshold = None
     ):
     retrievedDocs = retrievedDocs if queryNumber is None else retrievedDocs[retrievedDocs.queryNumber == queryNumber]       
-    retrievedDocs = filterRetrievedDocs(retrievedDocs, limit = limit, threshold = threshold)[["queryNumber", "documentID"]]
+    judgedRankings = getJudgedRankings(retrievedDocs, relevantDocs, limit = limit, threshold = threshold)
+    scores = scoreJudgedRankings(judgedRankings)
+    # The DCG lists hold one Python float per retrieved document, so they are
+    # only built when asked for
+    if _discountedCumulativeGainScore in scoreFuncs:
+        scores["_discountedCumulativeGainScore"] = getDiscountedCumulativeGainLists(judgedRankings)
+    return scores[["queryNumber"] + [scoreFunc.__name__ for scoreFunc in scoreFuncs]]
 
-    relevantDocs = relevantDocs.groupby("queryNumber").agg({
-        "documentID": lambda group: list(group),
-        "relevance": lambda group: list(group)
-    }).reset_index()
-    
-    queriesDocs = pd.merge(retrievedDocs, relevantDocs, how = "inner", on = "queryNumber")
-    queriesDocs.columns = ["queryNumber", "retrievedDoc", "relevantDoc", "relevantDocRelevance"]
-
-    for scoreFunc in scoreFuncs:
-        queriesDocs[scoreFunc.__name__] = queriesDocs.apply(lambda row: scoreFunc(row), axis = 1)
-    return queriesDocs.drop(["retrievedDoc", "relevantDoc", "relevantDocRelevance"], axis = 1)
-
-def plotElevenPoints(retrievedDF: pd.DataFrame, relevantDF: pd.DataFrame, limit = None, threshold = None):
-    scoresDF = getMetricScore(
-        retrievedDF, 
-        relevantDF, 
-        scoreFuncs = [_precisionScore, _recallScore],
-        limit = limit,
-        threshold = threshold
-    ).sort_values("_recallScore")
-    scoresDF._recallScore = scoresDF._recallScore.apply(lambda recall: f"{recall:.2f}")
-    scoresDF._precisionScore = scoresDF._precisionScore.apply(lambda precision: f"{precision:.2f}")
-
-    recallPrecisionTab = pd.crosstab(scoresDF._recallScore, scoresDF.queryNumber)
-    for row, recall in enumerate(recallPrecisionTab.index):
-        for column, queryNumber in enumerate(recallPrecisionTab.columns):
-            try:
-                precision = scoresDF[(scoresDF.queryNumber == queryNumber) & (scoresDF._recallScore == recall)].iloc[0]["_precisionScore"]
-                recallPrecisionTab.iloc[row, column] = float(precision)
-            except:
-                recallPrecisionTab.iloc[row, column] = float(recallPrecisionTab.iloc[row, column])
-
-    elevenPointsRecall = [f"{i/10:.2f}" for i in range(0,11)]
-    interpolatedPrecisionColumns = recallPrecisionTab.columns
-    elevenPointsDF = pd.DataFrame(data = {"R (%)": elevenPointsRecall})
-    elevenPointsDF[interpolatedPrecisionColumns] = 0
-    elevenPointsDF = elevenPointsDF.set_index("R (%)")
-
-    for row, recall in enumerate(elevenPointsDF.index):
-        for column, queryNumber in enumerate(elevenPointsDF.columns):
-            interpolatedPrecision = recallPrecisionTab[recallPrecisionTab.index >= recall][queryNumber].max()
-            elevenPointsDF.iloc[row, column] = interpolatedPrecision
-
-    elevenPointsDF["averagePrecision"] = elevenPointsDF.apply(lambda row: f"{row.mean():.2f}", axis = 1)
-    elevenPointsDF = elevenPointsDF.reset_index()[["R (%)", "averagePrecision"]]
-    elevenPointsDF.columns = ["Recall (%)", "Precision (%)"]
-    if list(elevenPointsDF["Precision (%)"].value_counts().index) == ["nan"]:
+def plotElevenPoints(retrievedDF: pd.DataFrame, relevantDF: pd.DataFrame, limit = None, threshold = None, returnPlot = True):
+    judgedRankings = getJudgedRankings(retrievedDF, relevantDF, limit = limit, threshold = threshold)
+    elevenPointsDF = getElevenPoints(judgedRankings)
+    if returnPlot:
+        return elevenPointsDF, plotElevenPointsCurve(elevenPointsDF)
+    else:
+        return elevenPointsDF
+
+def getInterpolatedPrecisions(judgedRankings, recallLevels = np.arange(11)/10) -> np.ndarray:
+    # Queries x recall levels matrix of interpolated precision: the highest
+    # precision at any rank whose recall reaches the level, taken from the
+    # precision/recall curve of every rank of each ranked list
+    isRelevant = judgedRankings["isRelevant"]
+    numRetrieved = judgedRankings["numRetrieved"]
+    numRelevant = judgedRankings["numRelevant"]
+    numQueries, numRanks = isRelevant.shape
+    relevantAtRank = np.cumsum(isRelevant, axis = 1)
+    retrievedRanks = np.arange(1, numRanks + 1)
+
+    precision = np.where(retrievedRanks <= numRetrieved[:, None], relevantAtRank/retrievedRanks, 0)
+    recall = relevantAtRank/numRelevant[:, None]
+    # Running maximum from the right: the best precision at this rank or after
+    maxPrecision = np.maximum.accumulate(precision[:, ::-1], axis = 1)[:, ::-1]
+    maxPrecision = np.hstack((maxPrecision, np.zeros((numQueries, 1))))
+    # Recall never decreases along a ranked list, so the first rank reaching
+    # each level is the number of ranks below it
+    firstRanks = (recall[:, :, None] < recallLevels).sum(axis = 1)
+    return np.take_along_axis(maxPrecision, firstRanks, axis = 1)
+
+def getElevenPoints(judgedRankings) -> pd.DataFrame:
+    if judgedRankings["numRetrieved"].sum() == 0:
         raise Exception("All queries retrieved 0 documents.")
-    elevenPointsDF = elevenPointsDF.apply(lambda column: [int(np.round(float(value)*100)) if value != "nan" else 0 for value in column])
+    recallLevels = np.arange(11)/10
+    averagePrecision = getInterpolatedPrecisions(judgedRankings, recallLevels).mean(axis = 0)
+    elevenPointsDF = pd.DataFrame({
+        "Recall (%)": np.round(recallLevels*100).astype(int),
+        "Precision (%)": np.round(averagePrecision*100).astype(int)
+    })
+    return elevenPointsDF
 
+def plotElevenPointsCurve(elevenPointsDF: pd.DataFrame):
+    plt, sns = importPlotting()
+    fig = plt.figure()
     fig = sns.lineplot(data = elevenPointsDF, x = "Recall (%)", y = "Precision (%)")
     plt.ylim([0,100])
     plt.xlim([0,100])
-
-    return elevenPointsDF, fig.get_figure()
+    return fig.get_figure()
 
 def rPrecisionHistogram(resultsA, resultsB, expectedResults):
     rPrecisionA = getMetricScore(resultsA, expectedResults, scoreFuncs = [_rPrecisionScore])
     rPrecisionB = getMetricScore(resultsB, expectedResults, scoreFuncs = [_rPrecisionScore])
+    rPrecision = getRPrecisionDelta(rPrecisionA, rPrecisionB)
+    return rPrecision, plotRPrecisionHistogram(rPrecision)
+
+def getRPrecisionDelta(rPrecisionA: pd.DataFrame, rPrecisionB: pd.DataFrame):
     rPrecision = pd.merge(rPrecisionA, rPrecisionB, on = "queryNumber", how = "inner")
     rPrecision["delta"] = rPrecision._rPrecisionScore_x - rPrecision._rPrecisionScore_y
     rPrecision = rPrecision[["queryNumber", "delta"]]
     rPrecision.columns = ["Query Number", "R-Precision A/B" ]
+    return rPrecision
+
+def plotRPrecisionHistogram(rPrecision: pd.DataFrame, ylabel = None):
+    plt, sns = importPlotting()
     fig = plt.figure(figsize = (14,5))
     fig = sns.barplot(data = rPrecision, x = "Query Number", y = "R-Precision A/B")
     plt.ylim([-1.05, 1.05])
     plt.xticks(rotation = 90)
-    return rPrecision, fig.get_figure()
+    if ylabel is not None:
+        plt.ylabel(ylabel)
+    return fig.get_figure()
 
 def meanAveragePrecision(retrieved, relevant):
     mapQueries = getMetricScore(retrieved, relevant, scoreFuncs = [_meanAveragePrecisionScore])
@@ -204,37 +376,24 @@ def meanReciprocalRank(retrieved, relevant, limit = 10):
     return queriesRR._meanReciprocalRankScore.mean()
 
 def discountedCumulativeGain(retrieved, relevant, limit = 20, returnPlot = True):
-    score = getMetricScore(retrieved, relevant, scoreFuncs = [_discountedCumulativeGainScore], limit = limit)
-    maxRetrievedDocs = score._discountedCumulativeGainScore.apply(len).max()
-    scoreVectors = []
-    for i, vector in enumerate(score._discountedCumulativeGainScore):
-        scoreVectors.append([])
-        for j in range(maxRetrievedDocs):
-            try:
-                value = vector[j]
-            except:
-                value = 0
-            scoreVectors[i].append(value)
-    scoreVectors = np.array(scoreVectors)
-    score = scoreVectors.mean(axis = 0)
+    judgedRankings = getJudgedRankings(retrieved, relevant, limit = limit)
+    score = getAverageDiscountedCumulativeGains(judgedRankings)
     if returnPlot:
-        fig = plt.figure(figsize = (8,6))
-        fig = sns.lineplot(x = range(1,len(score)+1), y = score)
-        plt.xlabel("Rank")
-        plt.ylabel("Average Discounted Cumulative Gain")
-        return score, fig.get_figure()
+        return score, plotDiscountedCumulativeGain(score)
     else:
         return score
-    
-def normalizedDiscountedCumulativeGain(retrieved, relevant, limit = 20):
-    relevances = relevant.set_index(["queryNumber", "documentID"]).to_dict()['relevance']
 
-    idealRetrieval = retrieved.copy(deep = True)
-    idealRetrieval["relevance"] = pd.Series([relevances.get(pair[1:],0) for pair in idealRetrieval[["queryNumber", "documentID"]].itertuples()])
-    idealRetrieval = idealRetrieval.sort_values(["queryNumber", "relevance"], ascending = [True, False]).drop("relevance", axis = 1)
-    idealRetrievalScore = discountedCumulativeGain(idealRetrieval, relevant, limit = limit, returnPlot = False)
-
-    retrievedScore = discountedCumulativeGain(retrieved, relevant, limit = limit, returnPlot = False)
+def plotDiscountedCumulativeGain(score):
+    plt, sns = importPlotting()
+    fig = plt.figure(figsize = (8,6))
+    fig = sns.lineplot(x = range(1,len(score)+1), y = score)
+    plt.xlabel("Rank")
+    plt.ylabel("Average Discounted Cumulative Gain")
+    return fig.get_figure()
     
-    score = retrievedScore / idealRetrievalScore
-    return score
\ No newline at end of file
+def normalizedDiscountedCumulativeGain(retrieved, relevant, limit = 20):
+    # Average NDCG@k of the queries at every rank k up to the limit
+    judgedRankings = getJudgedRankings(retrieved, relevant, limit = limit)
+    limit = judgedRankings["relevance"].shape[1] if limit is None else limit
+    score = getNormalizedDiscountedCumulativeGains(judgedRankings, np.arange(1, limit + 1)).mean(axis = 0)
+    return score
@@ -0,0 +1,44 @@
+import numpy as np
+
+SIGNIFICANCE_METHODS = ["randomization", "bootstrap"]
+
+# Resamples are drawn in chunks of at most this many resamples x queries
+# values, so memory stays bounded for any number of resamples
+MAX_CHUNK_VALUES = 10**7
+
+def getResampledMeans(differences: np.ndarray, method: str, numResamples: int, rng: np.random.Generator) -> np.ndarray:
+    # Mean difference of every resample under the null hypothesis, with the
+    # resamples x queries matrix drawn and reduced in NumPy
+    numQueries = len(differences)
+    chunkSize = max(1, MAX_CHUNK_VALUES // max(numQueries, 1))
+    means = []
+    for start in range(0, numResamples, chunkSize):
+        size = min(chunkSize, numResamples - start)
+        if method == "randomization":
+            # Paired randomization: the scores of both runs are exchangeable
+            # for each query, which flips the sign of its difference
+            signs = rng.integers(0, 2, size = (size, numQueries))*2 - 1
+            means.append(signs @ differences / numQueries)
+        else:
+            # Paired bootstrap: queries are resampled with replacement from
+            # the differences shifted to a zero mean
+            samples = rng.integers(0, numQueries, size = (size, numQueries))
+            means.append((differences - differences.mean())[samples].mean(axis = 1))
+    return np.concatenate(means)
+
+def pairedTest(scoresA: np.ndarray, scoresB: np.ndarray, method: str = "randomization", numResamples: int = 10000, seed: int = None):
+    # Two-sided test of the mean difference of paired per query scores. The
+    # p-value counts the observed difference as one of the resamples
+    if method not in SIGNIFICANCE_METHODS:
+        raise ValueError(f"Method should be one of the following: {', '.join(SIGNIFICANCE_METHODS)}")
+    scoresA, scoresB = np.asarray(scoresA, dtype = np.float64), np.asarray(scoresB, dtype = np.float64)
+    differences = scoresA - scoresB
+    if len(differences) == 0:
+        raise ValueError("At least one query is needed to compare two runs.")
+
+    observed = differences.mean()
+    means = getResampledMeans(differences, method, numResamples, np.random.default_rng(seed))
+    # Tolerance for sums that are equal but were added in another order
+    extreme = np.abs(means) >= np.abs(observed) - 1e-12
+    pValue = (extreme.sum() + 1)/(numResamples + 1)
+    return {"meanA": scoresA.mean(), "meanB": scoresB.mean(), "delta": observed, "pValue": pValue}
@@ -1,10 +1,16 @@
 import re
 import string
+from functools import lru_cache
 from unidecode import unidecode
 from nltk.tokenize import word_tokenize
 from nltk.corpus import stopwords
 from nltk.stem import PorterStemmer
 
+# Special characters and numbers
+CHARS_TO_REMOVE_REGEX = re.compile(r"["+string.punctuation+"0123456789"+"]")
+# Multiple white spaces and tabs
+WHITE_SPACES_REGEX = re.compile(" +|\t")
+
 def textPreprocessingFunc(text):
     # Removing accents
     text = unidecode(text)
@@ -13,27 +19,47 @@ def textPreprocessingFunc(text):
     text = text.strip()
 
     # Removing special characters and numbers
-    charsToRemove = string.punctuation + "0123456789"
-    text = re.sub(r"["+charsToRemove+"]", "", text)
+    text = CHARS_TO_REMOVE_REGEX.sub("", text)
 
     # Removing multiple white spaces and tabs
-    text = re.sub(" +|\t", " ", text)
+    text = WHITE_SPACES_REGEX.sub(" ", text)
 
     # Uppercase
     text = text.upper()
 
     return text
 
+class TextPipeline:
+    # Loads the stopwords and the stemmer once and memoizes the stemmed
+    # tokens in a bounded LRU cache, so it should be reused across texts
+    def __init__(self, useStemmer: bool = False, language: str = "english", stemCacheSize: int = 2**16):
+        self.useStemmer = useStemmer
+        self.language = language
+        self.stopWords = frozenset(stopwords.words(language))
+        self.stemmer = PorterStemmer() if useStemmer else None
+        self.stem = lru_cache(maxsize = stemCacheSize)(self.stemmer.stem) if useStemmer else None
+
+    def vectorize(self, text):
+        text = textPreprocessingFunc(text)
+        tokens = word_tokenize(text, language = self.language, preserve_line = False)
+
+        # Removing Stopwords
+        tokens = [token for token in tokens if token.lower() not in self.stopWords]
+
+        if self.useStemmer:
+            tokens = [self.stem(token) for token in tokens]
+
+        return tokens
+
+    def vectorizeMany(self, texts):
+        return [self.vectorize(text) for text in texts]
+
+textPipelines = {}
+
+def getTextPipeline(useStemmer = False) -> TextPipeline:
+    if useStemmer not in textPipelines:
+        textPipelines[useStemmer] = TextPipeline(useStemmer = useStemmer)
+    return textPipelines[useStemmer]
+
 def vectorizeText(text, useStemmer = False):
-    text = textPreprocessingFunc(text)
-    tokens = word_tokenize(text, language = "english", preserve_line = False)
-    
-    # Removin Stopwords
-    stopWords = set(stopwords.words('english'))
-    tokens = [token for token in tokens if not token.lower in stopWords]
-
-    if useStemmer:
-        stemmer = PorterStemmer()
-        tokens = [stemmer.stem(token) for token in tokens]
-
-    return tokens
\ No newline at end of file
+    return getTextPipeline(useStemmer).vectorize(text)
@@ -1,80 +1,251 @@
+import zlib
 import numpy as np
+from time import time
 from abc import ABC, abstractmethod
+from utils import compression
+
+def calculateCollectionStatistics(invertedList):
+    # Statistics of a whole collection that the weights depend on, so that
+    # each shard of the collection can be weighted as the whole collection
+    terms, documentCounts = np.unique(invertedList.term.to_numpy().astype(str), return_counts = True)
+    return {
+        "terms": terms,
+        "documentCounts": documentCounts,
+        "totalDocuments": invertedList.documentID.astype(str).nunique(),
+        "maxTermCount": invertedList.termCount.max()
+    }
 
 class WeightCalculator(ABC):
+    # The postings are stored in a CSR-like layout: the postings of the term
+    # with ordinal i are at positions termOffsets[i]:termOffsets[i+1] of the
+    # documentOrdinals, termCounts and weights arrays, sorted by document ordinal
     def __init__(self, invertedList):
-        self.invertedList = invertedList
-        self.documentIDs = self.getDocumentIDs()
+        # invertedList holds one (term, documentID, termCount) row per posting
+        self.terms, termOrdinals = np.unique(invertedList.term.to_numpy().astype(str), return_inverse = True)
+        self.documentIDs, documentOrdinals = np.unique(invertedList.documentID.to_numpy().astype(str), return_inverse = True)
+        self.termOffsets, self.documentOrdinals, self.termCounts = self.getPostings(
+            termOrdinals, documentOrdinals, invertedList.termCount.to_numpy()
+        )
+        self.termSlots = self.calculateSlots(self.terms)
+        self.documentSlots = self.calculateSlots(self.documentIDs)
+
+    @classmethod
+    def fromAttributes(cls, attributes):
+        # Rebuilds a calculator from already computed arrays (e.g. a stored model)
+        weightCalculator = cls.__new__(cls)
+        weightCalculator.__dict__.update(attributes)
+        return weightCalculator
+
+    def getPostings(self, termOrdinals, documentOrdinals, termCounts):
+        order = np.lexsort((documentOrdinals, termOrdinals))
+        termOffsets = np.zeros(len(self.terms) + 1, dtype = np.int64)
+        termOffsets[1:] = np.cumsum(np.bincount(termOrdinals, minlength = len(self.terms)))
+        documentOrdinals = documentOrdinals[order].astype(np.int32)
+        termCounts = termCounts[order].astype(np.int32)
+        return termOffsets, documentOrdinals, termCounts
+
+    @staticmethod
+    def hashKey(key):
+        return zlib.crc32(key.encode("utf-8"))
+
+    def calculateSlots(self, keys):
+        # Open addressing hash table from keys (terms or document IDs) to
+        # ordinals, with linear probing and at most half of the slots used (-1
+        # is an empty slot). Keys are inserted a probe step at a time: in each
+        # round, the first unplaced key whose current slot is empty takes it
+        numSlots = 2**max(1, int(np.ceil(np.log2(2*max(len(keys), 1)))))
+        keySlots = np.full(numSlots, -1, dtype = np.int32)
+        keyHashes = np.array([self.hashKey(key) for key in keys], dtype = np.int64)
+        unplaced = np.arange(len(keys))
+        probe = 0
+        while len(unplaced) > 0:
+            slots = (keyHashes[unplaced] + probe) & (numSlots - 1)
+            free = keySlots[slots] == -1
+            freeSlots, first = np.unique(slots[free], return_index = True)
+            placed = unplaced[free][first]
+            keySlots[freeSlots] = placed
+            placedMask = np.zeros(len(keys), dtype = bool)
+            placedMask[placed] = True
+            unplaced = unplaced[~placedMask[unplaced]]
+            probe += 1
+        return keySlots
+
+    def findOrdinal(self, keySlots, keys, key):
+        mask = len(keySlots) - 1
+        slot = self.hashKey(key) & mask
+        while True:
+            ordinal = int(keySlots[slot])
+            if ordinal == -1:
+                return None
+            if keys[ordinal] == key:
+                return ordinal
+            slot = (slot + 1) & mask
+
+    def getTermOrdinal(self, term):
+        # Every term lookup goes through the hash table stored with the model
+        return self.findOrdinal(self.termSlots, self.terms, term)
+
+    def getDocumentOrdinal(self, documentID):
+        # Document lookups go through a hash table stored with the model too
+        return self.findOrdinal(self.documentSlots, self.documentIDs, documentID)
+
+    def isCompressed(self) -> bool:
+        return "postingBlocks" in vars(self)
+
+    def compressPostings(self, blockSize = compression.POSTING_BLOCK_SIZE):
+        # Replaces the documentOrdinals and termCounts arrays by varint encoded
+        # blocks of document gaps and term counts (see utils.compression)
+        self.__dict__.update(compression.encodePostings(self.termOffsets, self.documentOrdinals, self.termCounts, blockSize))
+        self.postingBlockSize = blockSize
+        del self.documentOrdinals, self.termCounts
+
+    def getTermPostingData(self, termOrdinal, firstBlock = None, lastBlock = None):
+        # Document ordinals and term counts of the postings of a term (or of
+        # the blocks firstBlock:lastBlock of the term, when compressed)
+        if not self.isCompressed():
+            start, end = self.termOffsets[termOrdinal], self.termOffsets[termOrdinal + 1]
+            return self.documentOrdinals[start:end], self.termCounts[start:end]
+        blockStarts, blockEnds = compression.getTermBlocks(self.termOffsets, termOrdinal, self.postingBlockSize)
+        termFirstBlock = int(self.termBlockOffsets[termOrdinal])
+        firstBlock = termFirstBlock if firstBlock is None else firstBlock
+        lastBlock = int(self.termBlockOffsets[termOrdinal + 1]) if lastBlock is None else lastBlock
+        return compression.decodePostings(
+            self.postingBlocks, self.blockOffsets, self.blockLastOrdinals, firstBlock,
+            blockStarts[firstBlock - termFirstBlock:lastBlock - termFirstBlock],
+            blockEnds[firstBlock - termFirstBlock:lastBlock - termFirstBlock],
+            firstBlock == termFirstBlock
+        )
 
-    def getDocumentIDs(self):
-        documentIDs = self.invertedList.documentIDList.apply(
-            lambda document: list(document.index)
-        ).explode().unique()
-        return set(documentIDs)
+    def getDocumentOrdinals(self):
+        if not self.isCompressed():
+            return self.documentOrdinals
+        return compression.decodeAllPostings(self.termOffsets, self.postingBlocks, self.postingBlockSize)[0]
+
+    def findPosting(self, termOrdinal, documentOrdinal):
+        # Index and term count of the posting of a document in the postings of
+        # a term, or (None, 0) when the document does not have the term
+        start, end = self.termOffsets[termOrdinal], self.termOffsets[termOrdinal + 1]
+        if self.isCompressed():
+            # Only the block that may hold the document is decoded
+            termFirstBlock, termLastBlock = self.termBlockOffsets[termOrdinal], self.termBlockOffsets[termOrdinal + 1]
+            block = termFirstBlock + np.searchsorted(self.blockLastOrdinals[termFirstBlock:termLastBlock], documentOrdinal)
+            if block == termLastBlock:
+                return None, 0
+            documentOrdinals, termCounts = self.getTermPostingData(termOrdinal, block, block + 1)
+            start = start + (block - termFirstBlock) * self.postingBlockSize
+        else:
+            documentOrdinals, termCounts = self.documentOrdinals[start:end], self.termCounts[start:end]
+        position = np.searchsorted(documentOrdinals, documentOrdinal)
+        if position < len(documentOrdinals) and documentOrdinals[position] == documentOrdinal:
+            return start + position, int(termCounts[position])
+        return None, 0
+
+    def getPostingIndex(self, termOrdinal, documentOrdinal):
+        postingIndex, _ = self.findPosting(termOrdinal, documentOrdinal)
+        return postingIndex
 
     def getTermCountInDocument(self, documentID, term):
-        termCount = self.invertedList.loc[term].documentIDList.loc[documentID].termCount
+        termOrdinal = self.getTermOrdinal(term)
+        if termOrdinal is None:
+            raise Exception(f"Invalid term: the term {term} does not exist.")
+        documentOrdinal = self.getDocumentOrdinal(documentID)
+        if documentOrdinal is None:
+            raise Exception(f"Invalid document ID: the document {documentID} does not exist.")
+        _, termCount = self.findPosting(termOrdinal, documentOrdinal)
         return termCount
 
+    def getPostingsCompressionStats(self):
+        # Size of the postings (document ordinals and term counts) with and
+        # without compression, and time to decode all of them
+        numPostings = int(self.termOffsets[-1])
+        stats = {"postings": numPostings, "rawBytes": 8*numPostings, "compressedBytes": 8*numPostings, "decodeTime": 0.0}
+        if self.isCompressed():
+            stats["compressedBytes"] = sum(
+                array.nbytes for array in (self.postingBlocks, self.blockOffsets, self.termBlockOffsets, self.blockLastOrdinals)
+            )
+            startTime = time()
+            self.getDocumentOrdinals()
+            stats["decodeTime"] = time() - startTime
+        return stats
+
     def getDocumentCountForTerm(self, term):
-        documentCount = self.invertedList.loc[term].documentCount
-        return documentCount
+        termOrdinal = self.getTermOrdinal(term)
+        return self.termOffsets[termOrdinal + 1] - self.termOffsets[termOrdinal]
+
+    def calculateWeights(self, documentCounts = None):
+        # documentCounts holds the number of documents of each term, which by
+        # default is the length of its postings
+        termLengths = np.diff(self.termOffsets)
+        documentCounts = termLengths if documentCounts is None else documentCounts
+        documentCounts = np.repeat(documentCounts, termLengths)
+        weights = self.weightFunction(self.termCounts, documentCounts)
+        return weights.astype(np.float32)
 
     def calculateDocumentWeightLengths(self):
-        documentWeights = {}
-        for term in self.invertedList.index:
-            documents = self.invertedList.loc[term].documentIDList
-            for documentID in documents.index:
-                weight = self.getWeight(documentID, term, normalized = False)
-                if documentID in documentWeights.keys():
-                    documentWeights[documentID] += weight**2
-                else:
-                    documentWeights[documentID] = weight**2
-        documentWeights = {documentID: np.sqrt(sumSquaredWeights) for documentID, sumSquaredWeights in documentWeights.items()}
+        # Squared weights are summed per document in a single grouped reduction
+        squaredWeights = np.square(self.weights, dtype = np.float64)
+        documentWeights = np.bincount(self.documentOrdinals, weights = squaredWeights, minlength = len(self.documentIDs))
+        documentWeights = np.sqrt(documentWeights)
         return documentWeights
 
+    def calculateNormalizedWeights(self):
+        documentWeightLengths = self.documentWeightLengths[self.documentOrdinals]
+        normalizedWeights = np.divide(
+            self.weights, documentWeightLengths,
+            out = np.zeros(len(self.weights), dtype = np.float64),
+            where = documentWeightLengths > 0
+        )
+        return normalizedWeights.astype(np.float32)
+
+    def calculateMaxNormalizedWeights(self):
+        # Upper bound of each term contribution to a similarity (used for pruning)
+        return np.maximum.reduceat(self.normalizedWeights, self.termOffsets[:-1]).astype(np.float32)
+
     @abstractmethod
-    def weightFunction(self, documentID, term):
+    def weightFunction(self, termCounts, documentCounts):
         pass
 
     def getWeight(self, documentID, term, normalized = False):
-        if term not in self.invertedList.index:
+        termOrdinal = self.getTermOrdinal(term)
+        if termOrdinal is None:
             raise Exception(f"Invalid term: the term {term} does not exist.")
-        if documentID not in self.documentIDs:
+        documentOrdinal = self.getDocumentOrdinal(documentID)
+        if documentOrdinal is None:
             raise Exception(f"Invalid document ID: the document {documentID} does not exist.")
-        try:
-            weight = self.weightFunction(documentID, term)
-            if normalized:
-                weight = weight/self.documentWeightLengths[documentID]
-            return weight
-        except:
+        postingIndex = self.getPostingIndex(termOrdinal, documentOrdinal)
+        if postingIndex is None:
             return 0
+        weights = self.normalizedWeights if normalized else self.weights
+        return float(weights[postingIndex])
 
 class StandardTFIDF(WeightCalculator):
-    def __init__(self, invertedList):
+    def __init__(self, invertedList, collectionStatistics = None):
         super(StandardTFIDF, self).__init__(invertedList)
-        self.totalDocuments = self.calculateNumberOfDocuments()
-        self.maxTermCount = self.calculateMaxTermCount()
+        if collectionStatistics is None:
+            self.totalDocuments = self.calculateNumberOfDocuments()
+            self.maxTermCount = self.calculateMaxTermCount()
+            documentCounts = None
+        else:
+            self.totalDocuments = collectionStatistics["totalDocuments"]
+            self.maxTermCount = collectionStatistics["maxTermCount"]
+            documentCounts = collectionStatistics["documentCounts"][np.searchsorted(collectionStatistics["terms"], self.terms)]
+        self.weights = self.calculateWeights(documentCounts)
         self.documentWeightLengths = self.calculateDocumentWeightLengths()
+        self.normalizedWeights = self.calculateNormalizedWeights()
+        self.maxNormalizedWeights = self.calculateMaxNormalizedWeights()
 
-    def weightFunction(self, documentID, term):
-        termCount = self.getTermCountInDocument(documentID, term)
-        documentCount = self.getDocumentCountForTerm(term)
-        maxTermCount = self.maxTermCount
-        totalDocuments = self.totalDocuments
-
-        tf = termCount/maxTermCount
-        idf = np.log(totalDocuments/documentCount)
+    def weightFunction(self, termCounts, documentCounts):
+        tf = termCounts/self.maxTermCount
+        idf = np.log(self.totalDocuments/documentCounts)
 
         weight = tf*idf
 
         return weight
 
     def calculateNumberOfDocuments(self):
-        documentsIDs = self.invertedList.documentIDList.apply(lambda document: document.index).explode().unique()
-        totalDocuments = len(documentsIDs)
+        totalDocuments = len(self.documentIDs)
         return totalDocuments
-    
+
     def calculateMaxTermCount(self):
-        maxTermCount = self.invertedList.documentIDList.apply(lambda document: list(document.termCount)).explode().max()
-        return maxTermCount
\ No newline at end of file
+        maxTermCount = self.termCounts.max()
+        return maxTermCount